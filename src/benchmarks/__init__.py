@@ -0,0 +1,6 @@
+# encoding=utf8
+'''
+Бенчмарки: разбор страниц, сохранение объявлений, построение и отрисовка графиков.
+Работают без сети и без настоящей БД.
+@author: Mic, 2012
+'''
@@ -0,0 +1,145 @@
+# encoding=utf8
+'''
+Генераторы данных для бенчмарков.
+@author: Mic, 2012
+'''
+
+from datetime import datetime, timedelta
+from random import Random
+import os
+import re
+
+from dmte.models import Advert
+
+# Каталог с сохраненными страницами:
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+class AdvertGenerator(object):
+    '''
+    Генератор случайных объявлений, похожих на настоящие.
+    '''
+
+    TYPES = (u'вторичное', u'новостройка')
+
+    # Районы и средняя цена квадратного метра в них:
+    DISTRICTS = {
+        u'кировский': 52000,
+        u'ленинский': 41000,
+        u'октябрьский': 45000,
+        u'советский': 55000,
+        u'томский': 30000,
+    }
+
+    # Доля объявлений с ошибочной ценой (должны отсеиваться при построении графика):
+    BAD_PRICE_RATIO = 0.01
+
+    # За сколько дней генерировать объявления:
+    MAX_AGE = 365
+
+    def __init__(self, seed=0):
+        '''
+        @param seed: int
+        '''
+        self._random = Random(seed)
+        self._today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def _get_advert(self, external_id):
+        '''
+        Возвращает одно объявление.
+        @param external_id: int
+        @return: Advert
+        '''
+        random = self._random
+        advert = Advert()
+        advert.external_id = str(external_id)
+        advert.type = random.choice(self.TYPES)
+        advert.district = random.choice(sorted(self.DISTRICTS))
+        advert.floor_count = random.choice((2, 5, 9, 10, 12, 16))
+        advert.floor_number = random.randint(1, advert.floor_count)
+        advert.room_count = random.randint(1, 5)
+        advert.area = round(advert.room_count * 18 + random.uniform(5, 20), 1)
+        advert.address = u'ул. Тестовая, %s'%random.randint(1, 200)
+        price_per_metre = self.DISTRICTS[advert.district] * random.uniform(0.8, 1.2)
+        if random.random() < self.BAD_PRICE_RATIO:
+            price_per_metre *= 10
+        advert.price = round(advert.area * price_per_metre, -3)
+        advert.publication_date = self._today - timedelta(days=random.randint(0, self.MAX_AGE - 1))
+        return advert
+
+    def generate(self, count, first_id=1):
+        '''
+        Возвращает объявления по одному, не держа их все в памяти.
+        @param count: int
+        @param first_id: int
+        @return: generator
+        '''
+        for external_id in xrange(first_id, first_id + count):
+            yield self._get_advert(external_id)
+
+class ListingPageGenerator(object):
+    '''
+    Генератор страниц со списком объявлений на основе сохраненных страниц.
+    Строки объявлений со страниц повторяются с новыми идентификаторами.
+    '''
+
+    ROW_PATTERN = re.compile(r'<tr class="(?:odd|even)">.*?</tr>\s*', re.DOTALL)
+    ID_PATTERN = re.compile(r'id=(\d+)')
+    PAGER_PATTERN = re.compile(r'<div class="pager">.*?</div>', re.DOTALL)
+
+    # Блок ссылок на страницы со ссылкой на следующую и без нее:
+    NEXT_PAGER = '<div class="pager"><span class="pager_next"><a href="%s">&rarr;</a></span></div>'
+    LAST_PAGER = '<div class="pager"></div>'
+
+    def __init__(self):
+        self._pages = []
+        for name in sorted(os.listdir(FIXTURES_DIR)):
+            if name.startswith('listing-') and name.endswith('.html'):
+                with open(os.path.join(FIXTURES_DIR, name), 'rb') as page_file:
+                    self._pages.append(page_file.read())
+        self._rows = []
+        for page in self._pages:
+            self._rows.extend(self.ROW_PATTERN.findall(page))
+
+    @property
+    def pages(self):
+        '''
+        Возвращает сохраненные страницы как есть.
+        @return: list
+        '''
+        return self._pages
+
+    def generate(self, advert_count, first_id=1):
+        '''
+        Возвращает страницу с указанным количеством объявлений.
+        @param advert_count: int
+        @param first_id: int
+        @return: str
+        '''
+        rows = []
+        for index in xrange(advert_count):
+            row = self._rows[index % len(self._rows)]
+            rows.append(self.ID_PATTERN.sub('id=%s'%(first_id + index), row))
+        page = self._pages[0]
+        first_row = self.ROW_PATTERN.search(page)
+        last_row_end = list(self.ROW_PATTERN.finditer(page))[-1].end()
+        return page[:first_row.start()] + ''.join(rows) + page[last_row_end:]
+
+    def generate_site(self, page_count, advert_count, step, path='/realty/'):
+        '''
+        Возвращает страницы, связанные ссылками на следующую: первая - path,
+        остальные - path?page=N. На каждой следующей странице идентификаторы сдвигаются
+        на step, так что при step < advert_count часть объявлений переезжает
+        на следующую страницу (с другими данными).
+        @param page_count: int
+        @param advert_count: int - объявлений на странице
+        @param step: int
+        @param path: str
+        @return: list - пары (адрес, страница) по порядку
+        '''
+        urls = [path] + ['%s?page=%s'%(path, number) for number in xrange(2, page_count + 1)]
+        site = []
+        for index, url in enumerate(urls):
+            pager = self.NEXT_PAGER%urls[index + 1] if index + 1 < len(urls) else self.LAST_PAGER
+            page = self.PAGER_PATTERN.sub(pager, self.generate(advert_count, index * step + 1))
+            site.append((url, page))
+        return site
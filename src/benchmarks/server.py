@@ -0,0 +1,74 @@
+# encoding=utf8
+'''
+Локальный HTTP-сервер страниц для бенчмарков.
+@author: Mic, 2012
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from time import sleep
+
+class PageRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Отдает страницы сервера по адресу (с keep-alive).
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        page = self.server.pages.get(self.path)
+        sleep(self.server.latency)
+        if page is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=windows-1251')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+class PageServer(ThreadingMixIn, HTTPServer):
+    '''
+    Сервер заранее подготовленных страниц на свободном локальном порту.
+    Задержка перед каждым ответом изображает сеть.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, pages, latency=0):
+        '''
+        @param pages: dict - адрес -> страница
+        @param latency: float - задержка ответа (секунды)
+        '''
+        HTTPServer.__init__(self, ('127.0.0.1', 0), PageRequestHandler)
+        self.pages = pages
+        self.latency = latency
+
+    @property
+    def base_url(self):
+        '''
+        Возвращает адрес сервера без пути.
+        @return: str
+        '''
+        return 'http://%s:%s'%self.server_address
+
+    def start(self):
+        '''
+        Запускает сервер в отдельном потоке.
+        '''
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''
+        Останавливает сервер.
+        '''
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,25 @@
+# encoding=utf8
+'''
+БД для бенчмарков.
+@author: Mic, 2012
+'''
+
+from dmte.conf import settings
+from dmte.processors import MongoDb
+
+def use_memory_database():
+    '''
+    Подставляет вместо настоящей БД совместимую с MongoDB в памяти (mongomock).
+    '''
+    from mongomock import MongoClient
+    MongoDb.use(MongoClient()['benchmark'])
+
+def use_real_database():
+    '''
+    Подставляет отдельную БД на настоящем сервере из настроек.
+    Перед запуском БД очищается.
+    '''
+    database = MongoDb.get().connection['%s_benchmark'%settings.MONGO_DB['db_name']]
+    for name in database.collection_names(include_system_collections=False):
+        database.drop_collection(name)
+    MongoDb.use(database)
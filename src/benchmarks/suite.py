@@ -0,0 +1,364 @@
+# encoding=utf8
+'''
+Набор бенчмарков.
+@author: Mic, 2012
+'''
+
+from datetime import datetime, timedelta
+from subprocess import check_call
+from time import time
+import os
+import sys
+
+from lxml import etree
+
+from benchmarks.generators import AdvertGenerator, ListingPageGenerator
+from benchmarks.server import PageServer
+from dmte.conf import settings
+from dmte.graphics import GraphBuilder, GraphDrawer, GraphPoint
+from dmte.log import logger
+from dmte.processors import (AdvertProcessor, AdvertRollupProcessor, CrawlCheckpointProcessor, DataVersionProcessor,
+                             MongoDb)
+from dmte.source_data.loaders import PAGE_ENCODING
+from dmte.source_data.parsers import AdvertListParser
+from get_source_data import parse_all, save_adverts
+
+class BenchmarkResult(object):
+    '''
+    Результат одного бенчмарка.
+    '''
+
+    def __init__(self, name, unit, count, seconds, size=None):
+        '''
+        @param name: str
+        @param unit: str - что считается (adverts, graphs)
+        @param count: int
+        @param seconds: float
+        @param size: int - количество объявлений в БД
+        '''
+        self.name = name
+        self.unit = unit
+        self.count = count
+        self.seconds = seconds
+        self.size = size
+
+    @property
+    def key(self):
+        '''
+        Возвращает ключ для сравнения с предыдущими запусками.
+        @return: str
+        '''
+        if self.size is None:
+            return self.name
+        return '%s@%s'%(self.name, self.size)
+
+    @property
+    def rate(self):
+        '''
+        Возвращает производительность (штук в секунду).
+        @return: float
+        '''
+        return self.count / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        '''
+        Возвращает результат в виде словаря для JSON.
+        @return: dict
+        '''
+        return {
+            'name': self.name,
+            'unit': self.unit,
+            'count': self.count,
+            'seconds': self.seconds,
+            'size': self.size,
+            'rate': self.rate,
+        }
+
+    def __str__(self):
+        return '%-24s %10d %-7s %9.3fs %12.1f %s/s'%(self.key, self.count, self.unit, self.seconds, self.rate,
+                                                    self.unit)
+
+class BenchmarkSuite(object):
+    '''
+    Набор бенчмарков: запуск процессов, обход сайта, разбор страниц, сохранение объявлений,
+    построение и отрисовка графиков.
+    '''
+
+    # Сколько объявлений на странице (как на сайте):
+    PAGE_SIZE = 200
+
+    # Сколько страниц разбирать:
+    PARSE_PAGE_COUNT = 20
+
+    # Обход локального сайта: сколько страниц, сколько объявлений на странице, на сколько
+    # сдвигаются идентификаторы от страницы к странице, задержка ответа сервера
+    # и интервал между запросами (секунды):
+    CRAWL_PAGE_COUNT = 10
+    CRAWL_PAGE_SIZE = 50
+    CRAWL_STEP = 40
+    CRAWL_LATENCY = 0.05
+    CRAWL_HOST_INTERVAL = 0.2
+
+    # Сколько раз рисовать график:
+    DRAW_COUNT = 50
+
+    # Сколько точек на графике при отрисовке:
+    DRAW_POINT_COUNT = 365
+
+    # Сколько раз запускать процесс при замере времени запуска:
+    STARTUP_COUNT = 5
+
+    # Что импортируется при запуске: пустой интерпретатор, приложение uwsgi, обход сайта из cron:
+    STARTUP_IMPORTS = (
+        ('startup_python', None),
+        ('startup_site', 'dmte.site.views'),
+        ('startup_crawler', 'get_source_data'),
+    )
+
+    # Источники данных для графиков:
+    GRAPH_SOURCES = ('rollup', 'adverts', 'pipeline')
+
+    # Допустимое относительное расхождение средних, посчитанных разными способами:
+    CHECK_TOLERANCE = 1e-9
+
+    def __init__(self, sizes):
+        '''
+        @param sizes: list - количества объявлений в БД, для которых строить графики
+        '''
+        self._sizes = sizes
+        self.results = []
+        self.failures = []
+
+    def _add_result(self, result):
+        '''
+        Запоминает и печатает результат.
+        @param result: BenchmarkResult
+        '''
+        self.results.append(result)
+        logger.info('%s', result)
+
+    def _bench_startup(self):
+        '''
+        Запуск нового процесса с импортом точки входа (как при перезапуске воркера uwsgi или запуске из cron).
+        '''
+        source_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for name, module in self.STARTUP_IMPORTS:
+            command = [sys.executable, '-c', 'import %s'%module if module else 'pass']
+            started = time()
+            for _ in xrange(self.STARTUP_COUNT):
+                check_call(command, cwd=source_path)
+            self._add_result(BenchmarkResult(name, 'starts', self.STARTUP_COUNT, time() - started))
+
+    def _bench_parse(self):
+        '''
+        Разбор страниц со списком объявлений.
+        '''
+        generator = ListingPageGenerator()
+        page = generator.generate(self.PAGE_SIZE)
+        parser = AdvertListParser()
+        count = 0
+        started = time()
+        for _ in xrange(self.PARSE_PAGE_COUNT):
+            root_node = etree.fromstring(page, parser=etree.HTMLParser(encoding=PAGE_ENCODING))
+            count += len(list(parser.parse_adverts(root_node)))
+            parser.parse_next_page_address(root_node)
+        self._add_result(BenchmarkResult('parse', 'adverts', count, time() - started))
+
+    def _crawl(self, base_url, start_url, concurrent):
+        '''
+        Обходит все страницы локального сайта в отдельной БД в памяти.
+        Возвращает время обхода, объявления (идентификатор и отпечаток), сводку и состояние обхода.
+        @param base_url: str
+        @param start_url: str
+        @param concurrent: bool
+        @return: float, list, list, tuple
+        '''
+        from mongomock import MongoClient
+        database = MongoDb.get()
+        source_data = dict(settings.SOURCE_DATA)
+        MongoDb.use(MongoClient()['crawl'])
+        settings.SOURCE_DATA.update(base_url=base_url, start_url=start_url, host_interval=self.CRAWL_HOST_INTERVAL,
+                                    archive_path=None, validators_path=None)
+        try:
+            started = time()
+            parse_all(concurrent=concurrent)
+            seconds = time() - started
+            processor = AdvertProcessor()
+            adverts = sorted((advert.external_id, processor.get_fingerprint(advert))
+                             for advert in processor.get_by_info({}))
+            rollups = sorted(tuple(getattr(rollup, field) for field in AdvertRollupProcessor.KEY_FIELDS +
+                                   AdvertRollupProcessor.SUM_FIELDS)
+                             for rollup in AdvertRollupProcessor().get_by_info({}))
+            checkpoint = CrawlCheckpointProcessor().get(False)
+        finally:
+            settings.SOURCE_DATA.clear()
+            settings.SOURCE_DATA.update(source_data)
+            MongoDb.use(database)
+        return seconds, adverts, rollups, (checkpoint.last_url, checkpoint.next_url, checkpoint.page_count,
+                                           checkpoint.total_count, checkpoint.finished)
+
+    def _bench_crawl(self):
+        '''
+        Обход локального сайта с задержкой ответов по одной странице и в режиме concurrent
+        (скачивание следующей страницы во время разбора предыдущей). Выигрыш concurrent -
+        время разбора и сохранения, спрятанное в интервал между запросами и ожидание ответа.
+        Оба обхода должны дать одинаковые объявления, сводку и состояние обхода.
+        '''
+        site = ListingPageGenerator().generate_site(self.CRAWL_PAGE_COUNT, self.CRAWL_PAGE_SIZE, self.CRAWL_STEP)
+        server = PageServer(dict(site), self.CRAWL_LATENCY)
+        server.start()
+        try:
+            results = {}
+            for name, concurrent in (('crawl_sequential', False), ('crawl_concurrent', True)):
+                seconds, adverts, rollups, checkpoint = self._crawl(server.base_url, site[0][0], concurrent)
+                self._add_result(BenchmarkResult(name, 'pages', checkpoint[2], seconds))
+                results[name] = (adverts, rollups, checkpoint)
+        finally:
+            server.stop()
+        if results['crawl_sequential'] != results['crawl_concurrent']:
+            self.failures.append('crawl')
+            logger.error('sequential and concurrent crawls saved different adverts or checkpoints')
+
+    def _bench_store(self, count, first_id, size):
+        '''
+        Сохранение объявлений страницами, как при обходе сайта.
+        @param count: int - сколько объявлений добавить
+        @param first_id: int
+        @param size: int - сколько объявлений будет в БД после добавления
+        '''
+        generator = AdvertGenerator(seed=first_id)
+        adverts = generator.generate(count, first_id)
+        seconds = 0
+        page = []
+        for advert in adverts:
+            page.append(advert)
+            if len(page) == self.PAGE_SIZE:
+                started = time()
+                save_adverts(page)
+                seconds += time() - started
+                page = []
+        if page:
+            started = time()
+            save_adverts(page)
+            seconds += time() - started
+        DataVersionProcessor().bump()
+        self._add_result(BenchmarkResult('store', 'adverts', count, seconds, size))
+
+    def _get_graph_params(self):
+        '''
+        Возвращает набор параметров графиков: все типы и районы по отдельности и по парам.
+        @return: list
+        '''
+        aggregated = AdvertProcessor().get_aggregated()
+        params = [{}]
+        params.extend({'type': value} for value in aggregated['type'])
+        params.extend({'district': value} for value in aggregated['district'])
+        for type in aggregated['type']:
+            for district in aggregated['district']:
+                params.append({'type': type, 'district': district, 'room_count': 2})
+        return params
+
+    def _bench_build(self, size):
+        '''
+        Построение графиков из каждого источника данных.
+        @param size: int
+        '''
+        params = self._get_graph_params()
+        for source in self.GRAPH_SOURCES:
+            started = time()
+            for graph_params in params:
+                GraphBuilder().build(dict(graph_params), source)
+            self._add_result(BenchmarkResult('build_%s'%source, 'graphs', len(params), time() - started, size))
+
+    def _is_same_average(self, first, second):
+        '''
+        Проверяет, что средние по датам совпадают с точностью до порядка суммирования.
+        @param first: dict
+        @param second: dict
+        @return: bool
+        '''
+        if sorted(first) != sorted(second):
+            return False
+        return all(abs(first[key] - second[key]) <= self.CHECK_TOLERANCE * abs(first[key]) for key in first)
+
+    def _check_sources(self, size):
+        '''
+        Проверяет, что группировка в БД и группировка здесь дают одинаковые ряды,
+        а сводка - те же суммы, что и объявления. Сводка отбрасывает отклоняющиеся цены
+        целыми дневными группами, поэтому она сравнивается без отбрасывания.
+        @param size: int
+        '''
+        builder = GraphBuilder()
+        unfixed_builder = GraphBuilder()
+        unfixed_builder.FIX_RATIO = float('inf')
+        for graph_params in self._get_graph_params():
+            pipeline = builder.get_average(dict(graph_params), 'pipeline')
+            adverts = builder.get_average(dict(graph_params), 'adverts')
+            if not self._is_same_average(pipeline, adverts):
+                self.failures.append('pipeline@%s %r'%(size, graph_params))
+                logger.error('pipeline and adverts series differ for %r at %s adverts', graph_params, size)
+            rollup = unfixed_builder.get_average(dict(graph_params), 'rollup')
+            adverts = unfixed_builder.get_average(dict(graph_params), 'adverts')
+            if not self._is_same_average(rollup, adverts):
+                self.failures.append('rollup@%s %r'%(size, graph_params))
+                logger.error('rollup and adverts series differ for %r at %s adverts', graph_params, size)
+
+    def _check_site(self, size):
+        '''
+        Проверяет, что графики и данные с параметрами не латиницей строятся
+        и с нестандартными размером и интервалом группировки.
+        @param size: int
+        '''
+        from dmte.site.views import app
+        client = app.test_client()
+        aggregated = AdvertProcessor().get_aggregated()
+        type, district = sorted(aggregated['type'])[0], sorted(aggregated['district'])[0]
+        width, height = settings.GRAPH_IMAGE['sizes'][0]
+        urls = [
+            u'/graph/%s/%s/0/0/?resolution=week'%(type, district),
+            u'/graph/%s/all/0/0/?width=%s&height=%s'%(type, width, height),
+            u'/compare/district/%s/all/0/0/?resolution=month&width=%s&height=%s'%(type, width, height),
+            u'/data/%s/%s/0/0/?format=csv&resolution=week'%(type, district),
+        ]
+        for url in urls:
+            status_code = client.get(url.encode('utf8')).status_code
+            if status_code != 200:
+                self.failures.append(u'site@%s %s'%(size, url))
+                logger.error(u'%s returned %s at %s adverts', url, status_code, size)
+
+    def _bench_draw(self):
+        '''
+        Отрисовка графика по готовым точкам.
+        '''
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        points = []
+        for index in xrange(self.DRAW_POINT_COUNT):
+            publication_date = today - timedelta(days=index)
+            timestamp = int(publication_date.strftime('%s'))
+            points.append(GraphPoint(timestamp, 40000 + index * 10, publication_date.strftime('%Y-%m-%d')))
+        drawer = GraphDrawer()
+        started = time()
+        for _ in xrange(self.DRAW_COUNT):
+            drawer.draw(list(points), u'Бенчмарк')
+        self._add_result(BenchmarkResult('draw', 'graphs', self.DRAW_COUNT, time() - started))
+
+    def run(self):
+        '''
+        Запускает все бенчмарки.
+        Объявления добавляются в БД порциями, пока их количество не дойдет до очередного размера.
+        @return: list
+        '''
+        self._bench_startup()
+        self._bench_crawl()
+        self._bench_parse()
+        self._bench_draw()
+        AdvertProcessor().ensure_indexes()
+        AdvertRollupProcessor().ensure_indexes()
+        stored = 0
+        for size in sorted(self._sizes):
+            self._bench_store(size - stored, stored + 1, size)
+            stored = size
+            self._bench_build(size)
+            self._check_sources(size)
+            self._check_site(size)
+        return self.results
@@ -1,15 +1,20 @@
 # encoding=utf8
 '''
 Построение графиков.
+PIL, шрифт и numpy загружаются при первом построении, а не при импорте:
+сайту для главной страницы и графиков из кэша они не нужны.
 @author: Mic, 2012
 '''
 
 from datetime import datetime, timedelta
 from StringIO import StringIO
 
-import Image, ImageDraw, ImageFont
+from pymongo.errors import OperationFailure
 
-from dmte.processors import AdvertProcessor
+from dmte.conf import settings
+from dmte.log import logger
+from dmte.metrics import graph_stage_seconds
+from dmte.processors import AdvertProcessor, AdvertRollupProcessor
 
 class GraphPoint(object):
     '''
@@ -33,13 +38,18 @@ class GraphDrawer(object):
     Рисовальщик графика.
     '''
     
-    # Размеры картинки:
+    # Размеры картинки по умолчанию:
     IMAGE_WIDTH = 900
     IMAGE_HEIGHT = 330
+
+    # Допустимые размеры картинки:
+    MIN_IMAGE_WIDTH = 200
+    MAX_IMAGE_WIDTH = 2700
+    MIN_IMAGE_HEIGHT = 100
+    MAX_IMAGE_HEIGHT = 990
     
-    # Размеры графика:
-    GRAPH_WIDTH = 900
-    GRAPH_HEIGHT = 300
+    # Высота полосы для подписи под графиком:
+    LEGEND_HEIGHT = 30
     
     # Цвета и шрифты:
     BACKGROUND_COLOR = 'white'
@@ -48,25 +58,86 @@ class GraphDrawer(object):
     CURRENT_LEVEL_COLOR = 'lightgray'
     TEXT_LABEL_COLOR = 'lightgray'
     TEXT_COLOR = 'black'
-    TEXT_FONT = ImageFont.truetype('/usr/share/fonts/truetype/ttf-dejavu/DejaVuSerif.ttf', 12)
+    # Цвета линий при сравнении нескольких рядов:
+    SERIES_COLORS = ('black', 'red', 'blue', 'green', 'orange', 'purple', 'brown', 'magenta', 'teal', 'gray')
+
+    # Шрифт (загружается при первой отрисовке):
+    _font = None
+
+    # Заготовки картинок (фон и рамка) по размерам:
+    _base_images = {}
+
+    def __init__(self, width=None, height=None):
+        '''
+        @param width: int - ширина картинки (по умолчанию IMAGE_WIDTH)
+        @param height: int - высота картинки (по умолчанию IMAGE_HEIGHT)
+        '''
+        self._image_width = width or self.IMAGE_WIDTH
+        self._image_height = height or self.IMAGE_HEIGHT
+        self._graph_width = self._image_width
+        self._graph_height = self._image_height - self.LEGEND_HEIGHT
+
+    @classmethod
+    def is_valid_size(cls, width, height):
+        '''
+        Проверяет, что картинку такого размера можно нарисовать.
+        @param width: int
+        @param height: int
+        @return: bool
+        '''
+        return (cls.MIN_IMAGE_WIDTH <= width <= cls.MAX_IMAGE_WIDTH and
+                cls.MIN_IMAGE_HEIGHT <= height <= cls.MAX_IMAGE_HEIGHT)
+
+    @classmethod
+    def _get_font(cls):
+        '''
+        Возвращает шрифт подписей (из настроек), загружая его один раз на процесс.
+        @return: FreeTypeFont
+        '''
+        if cls._font is None:
+            import ImageFont
+            cls._font = ImageFont.truetype(settings.GRAPH_IMAGE['font_path'], settings.GRAPH_IMAGE['font_size'])
+        return cls._font
+
+    def _get_base_image(self):
+        '''
+        Возвращает заготовку картинки текущего размера: фон и рамку.
+        Заготовка рисуется один раз на процесс.
+        @return: Image
+        '''
+        import Image, ImageDraw
+        key = (self._image_width, self._image_height)
+        base_image = self._base_images.get(key)
+        if base_image is None:
+            base_image = Image.new('RGB', key, self.BACKGROUND_COLOR)
+            self._draw_border(ImageDraw.Draw(base_image))
+            self._base_images[key] = base_image
+        return base_image
     
     def _get_new_image(self):
         '''
-        Возвращает новую картинку.
+        Возвращает новую картинку: копию заготовки.
         @return: Image
         '''
-        return Image.new('RGB', (self.IMAGE_WIDTH, self.IMAGE_HEIGHT), self.BACKGROUND_COLOR)
+        return self._get_base_image().copy()
     
     def _get_image_body(self, image):
         '''
         Возвращает тело картинки.
+        Степень сжатия и перевод в палитру задаются в настройках.
         @param image: Image
         @return: str
         '''
-        output = StringIO()
-        image.save(output, format='PNG')
-        output.seek(0)
-        return output.read()
+        import Image
+        options = settings.GRAPH_IMAGE
+        with graph_stage_seconds.time(stage='encode'):
+            if options['palette'] == 'web':
+                image = image.convert('P', palette=Image.WEB, dither=Image.NONE)
+            elif options['palette'] == 'adaptive':
+                image = image.convert('P', palette=Image.ADAPTIVE, colors=options['palette_colors'])
+            output = StringIO()
+            image.save(output, format='PNG', compress_level=options['compress_level'])
+        return output.getvalue()
     
     def _get_bounds(self, points):
         '''
@@ -91,7 +162,10 @@ class GraphDrawer(object):
         @param value: float
         @return: float
         '''
-        return self.GRAPH_WIDTH * (value - min_value) / float(max_value - min_value)
+        if max_value == min_value:
+            # Все точки в один день - ставим их посередине:
+            return self._graph_width / 2.0
+        return self._graph_width * (value - min_value) / float(max_value - min_value)
     
     def _get_value_y(self, min_value, max_value, value):
         '''
@@ -101,7 +175,10 @@ class GraphDrawer(object):
         @param value: float
         @return: float
         '''
-        return self.GRAPH_HEIGHT - self.GRAPH_HEIGHT * (value - min_value) / float(max_value - min_value)
+        if max_value == min_value:
+            # Все значения равны нижней границе - ставим их на нее:
+            return self._graph_height
+        return self._graph_height - self._graph_height * (value - min_value) / float(max_value - min_value)
     
     def _get_point_coords(self, point, bounds):
         '''
@@ -119,14 +196,15 @@ class GraphDrawer(object):
         Рисует рамку.
         @param draw: Draw
         '''
-        draw.rectangle((0, 0, self.GRAPH_WIDTH - 1, self.GRAPH_HEIGHT - 1), outline=self.BORDER_COLOR)
+        draw.rectangle((0, 0, self._graph_width - 1, self._graph_height - 1), outline=self.BORDER_COLOR)
     
-    def _draw_points(self, draw, points, bounds):
+    def _draw_points(self, draw, points, bounds, color=None):
         '''
         Рисует точки и соединяет их линией.
         @param draw: Draw
         @param points: list
         @param bounds: dict
+        @param color: str
         '''
         if not points:
             return
@@ -136,9 +214,47 @@ class GraphDrawer(object):
             x, y = self._get_point_coords(point, bounds)
             if prev_x is not None and prev_y is not None:
                 coords = (prev_x, prev_y, x, y)
-                draw.line(coords, fill=self.LINE_COLOR)
+                draw.line(coords, fill=color or self.LINE_COLOR)
             prev_x, prev_y = x, y
 
+    def _get_triangle_area(self, first, second, third_x, third_y):
+        '''
+        Возвращает удвоенную площадь треугольника по трем точкам.
+        @param first: GraphPoint
+        @param second: GraphPoint
+        @param third_x: float
+        @param third_y: float
+        @return: float
+        '''
+        return abs((first.x - third_x) * (second.y - first.y) - (first.x - second.x) * (third_y - first.y))
+
+    def _get_downsampled(self, points, threshold):
+        '''
+        Прореживает отсортированные по X точки до threshold штук с сохранением формы
+        (Largest-Triangle-Three-Buckets): точки делятся на корзины, и из каждой
+        берется точка, образующая наибольший треугольник с выбранной точкой
+        предыдущей корзины и средней точкой следующей. Первая и последняя точки сохраняются.
+        @param points: list
+        @param threshold: int
+        @return: list
+        '''
+        if threshold >= len(points) or threshold < 3:
+            return points
+        sampled = [points[0]]
+        bucket_size = (len(points) - 2) / float(threshold - 2)
+        selected = points[0]
+        for index in xrange(threshold - 2):
+            start = int(index * bucket_size) + 1
+            end = int((index + 1) * bucket_size) + 1
+            next_points = points[end:min(int((index + 2) * bucket_size) + 1, len(points))]
+            average_x = sum(point.x for point in next_points) / float(len(next_points))
+            average_y = sum(point.y for point in next_points) / float(len(next_points))
+            selected = max(points[start:end],
+                           key=lambda point: self._get_triangle_area(selected, point, average_x, average_y))
+            sampled.append(selected)
+        sampled.append(points[-1])
+        return sampled
+
     def _draw_label(self, draw, x, y, text):
         '''
         Рисует текстовую метку.
@@ -147,9 +263,9 @@ class GraphDrawer(object):
         @param text: str
         '''
         width, height = draw.textsize(text)
-        if x + width > self.GRAPH_WIDTH:
+        if x + width > self._graph_width:
             x -= width
-        if y + height > self.GRAPH_HEIGHT:
+        if y + height > self._graph_height:
             y -= height
         draw.rectangle((x - 2, y - 2, x + width + 2, y + height + 2), fill=self.TEXT_LABEL_COLOR)
         draw.text((x, y), text, fill=self.TEXT_COLOR)
@@ -182,7 +298,27 @@ class GraphDrawer(object):
         Рисует подпись к графику.
         @param text: str
         '''
-        draw.text((0, self.GRAPH_HEIGHT + 2), text, fill=self.TEXT_COLOR, font=self.TEXT_FONT)
+        draw.text((0, self._graph_height + 2), text, fill=self.TEXT_COLOR, font=self._get_font())
+
+    def _draw_series_legend(self, draw, labels):
+        '''
+        Рисует подписи рядов их цветами справа от подписи к графику.
+        @param draw: Draw
+        @param labels: list
+        '''
+        x = self._graph_width
+        for index, label in reversed(list(enumerate(labels))):
+            width, _ = draw.textsize(label, font=self._get_font())
+            x -= width + 10
+            draw.text((x, self._graph_height + 2), label, fill=self._get_series_color(index), font=self._get_font())
+
+    def _get_series_color(self, index):
+        '''
+        Возвращает цвет ряда по его номеру.
+        @param index: int
+        @return: str
+        '''
+        return self.SERIES_COLORS[index % len(self.SERIES_COLORS)]
 
     def draw(self, points, legend):
         '''
@@ -191,14 +327,33 @@ class GraphDrawer(object):
         @param legend: str
         @return: str
         '''
-        image = self._get_new_image()
-        draw = ImageDraw.Draw(image)
-        bounds = self._get_bounds(points)
-        self._draw_border(draw)
-        self._draw_points(draw, points, bounds)
-        self._draw_labels(draw, bounds)
-        self._draw_current_level(draw, bounds)
-        self._draw_legend(draw, legend)
+        return self.draw_series([(None, points)], legend)
+
+    def draw_series(self, series, legend):
+        '''
+        Рисует несколько рядов точек в общем масштабе и возвращает тело картинки.
+        Ряды, в которых точек больше, чем пикселей по ширине, прореживаются.
+        Уровень цены на данный момент рисуется, только если ряд один.
+        @param series: list - пары (подпись, список точек)
+        @param legend: str
+        @return: str
+        '''
+        import ImageDraw
+        with graph_stage_seconds.time(stage='render'):
+            series = [(label, self._get_downsampled(sorted(points, key=lambda point: point.x), self._graph_width))
+                      for label, points in series]
+            image = self._get_new_image()
+            draw = ImageDraw.Draw(image)
+            bounds = self._get_bounds([point for _, points in series for point in points])
+            for index, (_, points) in enumerate(series):
+                color = self._get_series_color(index) if len(series) > 1 else None
+                self._draw_points(draw, points, bounds, color)
+            self._draw_labels(draw, bounds)
+            if len(series) == 1:
+                self._draw_current_level(draw, bounds)
+            self._draw_legend(draw, legend)
+            if len(series) > 1:
+                self._draw_series_legend(draw, [label for label, _ in series])
         return self._get_image_body(image)
 
 class GraphBuilder(object):
@@ -212,117 +367,362 @@ class GraphBuilder(object):
     # Максимальное значение отношения суммы объявления к средней сумме группы,
     # после достижения которого объявление считается плохим:
     FIX_RATIO = 3.0
+
+    # Поля объявлений, нужные для графика:
+    ADVERT_FIELDS = ('publication_date', 'price', 'area')
+
+    # Сколько объявлений получать из БД за раз:
+    QUERY_BATCH_SIZE = 5000
+
+    # Интервалы, по которым группируются точки графика, и их подписи в легенде:
+    RESOLUTIONS = ('day', 'week', 'month')
+    RESOLUTION_LEGENDS = {
+        'week': u'Средние по неделям.',
+        'month': u'Средние по месяцам.',
+    }
+
+    # Подписи легенды для поля, по которому сравниваются ряды:
+    COMPARE_LEGENDS = {
+        'type': u'по типам',
+        'district': u'по районам',
+        'floor_number': u'по этажам',
+        'room_count': u'по количеству комнат',
+    }
     
-    def _get_adverts(self, params):
+    def _get_adverts(self, params, by=None):
         '''
         Возвращает объявления по критериям.
-        @return: list
+        @param params: dict
+        @param by: str - поле, по которому сравниваются ряды
+        @return: iterator
         '''
         processor = AdvertProcessor()
-        params['publication_date'] = {'$gt': datetime.utcnow() - timedelta(days=self.ADVERT_MAX_AGE)}
-        return processor.get_by_info(params)
-    
-    def _get_average(self, adverts):
+        fields = self.ADVERT_FIELDS if by is None else self.ADVERT_FIELDS + (by,)
+        return processor.get_by_info(params, fields, self.QUERY_BATCH_SIZE)
+
+    def _get_rollups(self, params):
         '''
-        Возвращает среднее для списка объявлений.
-        @param adverts: list
-        @return: float
+        Возвращает сводки по объявлениям по критериям.
+        Сводки группируются и усредняются так же, как объявления, но отклоняющиеся
+        от средних значений отбрасываются целиком, вместе со всеми объявлениями
+        своей группы за день, поэтому средние могут отличаться от средних по объявлениям.
+        @return: list
         '''
-        price = sum(advert.price for advert in adverts)
-        area = sum(advert.area for advert in adverts)
-        return price / area
-    
-    def _fix_groupped(self, groupped):
+        processor = AdvertRollupProcessor()
+        return processor.get_by_info(params)
+
+    def _get_rows(self, params, source, by=None):
         '''
-        Возвращает подправленные данные: убирает объявления, сильно отклоняющиеся
-        от средних значений.
-        @param groupped: dict
-        @return: dict
+        Возвращает данные для графика из указанного источника.
+        @param params: dict
+        @param source: str
+        @param by: str - поле, по которому сравниваются ряды
+        @return: list
         '''
-        fixed = {}
-        for publication_date, adverts in groupped.items():
-            total_average = self._get_average(adverts)
-            fixed_group = []
-            for advert in adverts:
-                average = advert.price / advert.area
-                if 1 / self.FIX_RATIO < average / total_average < self.FIX_RATIO:
-                    fixed_group.append(advert)
-            if fixed_group:
-                fixed[publication_date] = fixed_group
-        return fixed
+        if source == 'rollup':
+            return self._get_rollups(params)
+        return self._get_adverts(params, by)
     
-    def _group_by_date(self, adverts):
+    def _get_pipeline_sums(self, params, by=None):
         '''
-        Возвращает объявления, сгруппированные по дате.
-        @param adverts: list
-        @return: dict
+        Возвращает суммы цен и площадей по рядам и датам, посчитанные в БД.
+        @param params: dict
+        @param by: str - поле, по которому сравниваются ряды
+        @return: ndarray, ndarray, ndarray
         '''
-        groupped = {}
-        for advert in adverts:
-            if advert.publication_date not in groupped:
-                groupped[advert.publication_date] = []
-            groupped[advert.publication_date].append(advert)
-        return self._fix_groupped(groupped)
+        import numpy
+        processor = AdvertProcessor()
+        rows = processor.get_groupped_by_date(params, self.FIX_RATIO, by)
+        keys = numpy.empty(len(rows), dtype=object)
+        keys[:] = [(value, publication_date) for value, publication_date, _, _ in rows]
+        prices = numpy.array([price for _, _, price, _ in rows], dtype=float)
+        areas = numpy.array([area for _, _, _, area in rows], dtype=float)
+        return keys, prices, areas
 
-    def _get_groupped_average(self, groupped):
-        '''
-        Возвращает средние цены за квадратный метр, сгруппированные по дате.
-        @param groupped: dict
-        @return: dict
+    def _get_series(self, params, source, by=None, resolution='day'):
         '''
-        average = {}
-        for publication_date, adverts in groupped.items():
-            average[publication_date] = self._get_average(adverts)
-        return average
+        Возвращает средние цены по рядам и датам из указанного источника.
+        Если БД не смогла посчитать суммы, они считаются здесь по объявлениям.
+        Запрос и группировка засчитываются в метрику по одному разу.
+        @param params: dict
+        @param source: str
+        @param by: str - поле, по которому сравниваются ряды
+        @param resolution: str - day, week или month
+        @return: dict - значение поля by -> {дата: средняя цена}
+        '''
+        sums, columns = None, None
+        if source == 'pipeline':
+            try:
+                with graph_stage_seconds.time(stage='query'):
+                    sums = self._get_pipeline_sums(params, by)
+            except OperationFailure as e:
+                logger.warning('aggregation pipeline failed, grouping adverts here: %s', e)
+        if sums is None:
+            with graph_stage_seconds.time(stage='query'):
+                columns = self._get_columns(self._get_rows(params, source, by), by)
+        with graph_stage_seconds.time(stage='aggregation'):
+            if sums is None:
+                sums = self._get_groupped_sums(*columns)
+            return self._get_groupped_average(*self._get_bucketed_sums(*sums, resolution=resolution))
+
+    def _get_columns(self, rows, by=None):
+        '''
+        Возвращает данные объявлений (или сводок) столбцами: список различных групп
+        (значение поля by и дата), номер группы, цену и площадь для каждой строки.
+        @param rows: list
+        @param by: str - поле, по которому сравниваются ряды
+        @return: ndarray, ndarray, ndarray, ndarray
+        '''
+        import numpy
+        keys, groups, prices, areas = {}, [], [], []
+        for row in rows:
+            key = (getattr(row, by) if by is not None else None, row.publication_date)
+            groups.append(keys.setdefault(key, len(keys)))
+            prices.append(row.price)
+            areas.append(row.area)
+        unique_keys = numpy.empty(len(keys), dtype=object)
+        for key, group in keys.items():
+            unique_keys[group] = key
+        return (unique_keys, numpy.array(groups, dtype=numpy.intp), numpy.array(prices, dtype=float),
+                numpy.array(areas, dtype=float))
+
+    def _get_groupped_sums(self, keys, groups, prices, areas):
+        '''
+        Возвращает суммы цен и площадей, сгруппированные по ряду и дате.
+        Объявления, сильно отклоняющиеся от среднего значения своей группы, не учитываются;
+        группы, в которых ничего не осталось, выбрасываются.
+        @param keys: ndarray
+        @param groups: ndarray
+        @param prices: ndarray
+        @param areas: ndarray
+        @return: ndarray, ndarray, ndarray
+        '''
+        import numpy
+        group_count = len(keys)
+        total_average = numpy.bincount(groups, prices, group_count) / numpy.bincount(groups, areas, group_count)
+        ratio = prices / areas / total_average[groups]
+        fixed = (1 / self.FIX_RATIO < ratio) & (ratio < self.FIX_RATIO)
+        fixed_groups = groups[fixed]
+        fixed_prices = numpy.bincount(fixed_groups, prices[fixed], group_count)
+        fixed_areas = numpy.bincount(fixed_groups, areas[fixed], group_count)
+        present = numpy.bincount(fixed_groups, minlength=group_count) > 0
+        return keys[present], fixed_prices[present], fixed_areas[present]
+
+    def _get_bucket(self, publication_date, resolution):
+        '''
+        Возвращает начало интервала, в который попадает дата.
+        @param publication_date: datetime
+        @param resolution: str - day, week или month
+        @return: datetime
+        '''
+        day = publication_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if resolution == 'week':
+            return day - timedelta(days=day.weekday())
+        if resolution == 'month':
+            return day.replace(day=1)
+        return publication_date
 
-    def _get_graph_legend(self, params):
+    def _get_bucketed_sums(self, keys, prices, areas, resolution):
+        '''
+        Возвращает суммы цен и площадей, сгруппированные по ряду и интервалу (неделе или месяцу).
+        Суммы по дням просто складываются, так что средняя за интервал взвешена по площади.
+        @param keys: ndarray
+        @param prices: ndarray
+        @param areas: ndarray
+        @param resolution: str - day, week или month
+        @return: ndarray, ndarray, ndarray
+        '''
+        import numpy
+        if resolution == 'day':
+            return keys, prices, areas
+        buckets, groups = {}, []
+        for value, publication_date in keys:
+            bucket = (value, self._get_bucket(publication_date, resolution))
+            groups.append(buckets.setdefault(bucket, len(buckets)))
+        unique_buckets = numpy.empty(len(buckets), dtype=object)
+        for bucket, group in buckets.items():
+            unique_buckets[group] = bucket
+        groups = numpy.array(groups, dtype=numpy.intp)
+        return (unique_buckets, numpy.bincount(groups, prices, len(buckets)),
+                numpy.bincount(groups, areas, len(buckets)))
+
+    def _get_groupped_average(self, keys, prices, areas):
+        '''
+        Возвращает средние цены за квадратный метр, сгруппированные по ряду и дате.
+        @param keys: ndarray
+        @param prices: ndarray
+        @param areas: ndarray
+        @return: dict - значение поля by -> {дата: средняя цена}
+        '''
+        series = {}
+        for (value, publication_date), average in zip(keys, (prices / areas).tolist()):
+            series.setdefault(value, {})[publication_date] = average
+        return series
+
+    def _get_graph_legend(self, params, by=None, resolution='day'):
         '''
         Возвращает легенду для графика.
         @param params: dict
+        @param by: str - поле, по которому сравниваются ряды
+        @param resolution: str - интервал группировки точек
         @return: str
         '''
         legend = []
-        if 'type' in params:
+        if by == 'type':
+            legend.append(self.COMPARE_LEGENDS[by].capitalize())
+        elif 'type' in params:
             legend.append(params['type'].capitalize())
         else:
             legend.append(u'Любого типа')
-        if 'district' in params:
+        if by == 'district':
+            legend.append(self.COMPARE_LEGENDS[by])
+        elif 'district' in params:
             legend.append(u'%s район'%params['district'].capitalize())
         else:
             legend.append(u'любой район')
-        if 'floor_number' in params:
+        if by == 'floor_number':
+            legend.append(self.COMPARE_LEGENDS[by])
+        elif 'floor_number' in params:
             legend.append(u'%s этаж'%params['floor_number'])
         else:
             legend.append(u'любой этаж')
-        if 'room_count' in params:
+        if by == 'room_count':
+            legend.append(self.COMPARE_LEGENDS[by])
+        elif 'room_count' in params:
             legend.append(u'%s-комнатное'%params['room_count'])
         else:
             legend.append(u'любое количество комнат')
-        return ', '.join(legend) + '.'
-    
-    def _build_graph(self, average, params):
+        legend = ', '.join(legend) + '.'
+        if resolution in self.RESOLUTION_LEGENDS:
+            legend = u'%s %s'%(legend, self.RESOLUTION_LEGENDS[resolution])
+        return legend
+
+    def _get_series_label(self, by, value):
         '''
-        Строит график и возвращает картинку строкой.
-        @param average: dict
-        @param params: dict
+        Возвращает подпись ряда на сравнительном графике.
+        @param by: str
+        @param value: mixed
         @return: str
         '''
+        if by == 'floor_number':
+            return u'%s эт.'%value
+        if by == 'room_count':
+            return u'%s-комн.'%value
+        return value.capitalize()
+
+    def _get_points(self, average):
+        '''
+        Возвращает точки графика по средним ценам.
+        @param average: dict
+        @return: list
+        '''
         points = []
         for publication_date, value in average.items():
             timestamp = int(publication_date.strftime('%s'))
             label = publication_date.strftime('%Y-%m-%d')
             points.append(GraphPoint(timestamp, value, label))
-        graph_drawer = GraphDrawer()
-        legend = self._get_graph_legend(params)
-        return graph_drawer.draw(points, legend)
+        return points
     
-    def build(self, params):
+    def _build_graph(self, average, params, width=None, height=None, resolution='day'):
+        '''
+        Строит график и возвращает картинку строкой.
+        @param average: dict
+        @param params: dict
+        @param width: int
+        @param height: int
+        @param resolution: str
+        @return: str
+        '''
+        graph_drawer = GraphDrawer(width, height)
+        legend = self._get_graph_legend(params, resolution=resolution)
+        return graph_drawer.draw(self._get_points(average), legend)
+
+    def _build_comparison_graph(self, series, params, by, width=None, height=None, resolution='day'):
+        '''
+        Строит сравнительный график и возвращает картинку строкой.
+        @param series: dict - значение поля by -> средние цены по датам
+        @param params: dict
+        @param by: str
+        @param width: int
+        @param height: int
+        @param resolution: str
+        @return: str
+        '''
+        graph_series = [(self._get_series_label(by, value), self._get_points(series[value]))
+                        for value in sorted(series)]
+        graph_drawer = GraphDrawer(width, height)
+        legend = self._get_graph_legend(params, by, resolution)
+        return graph_drawer.draw_series(graph_series, legend)
+    
+    def _get_date_filter(self, date_from, date_to):
+        '''
+        Возвращает условие на дату публикации.
+        Без начала интервала берутся объявления за последние ADVERT_MAX_AGE дней.
+        @param date_from: datetime
+        @param date_to: datetime
+        @return: dict
+        '''
+        if date_from is None:
+            date_filter = {'$gt': datetime.utcnow() - timedelta(days=self.ADVERT_MAX_AGE)}
+        else:
+            date_filter = {'$gte': date_from}
+        if date_to is not None:
+            date_filter['$lte'] = date_to
+        return date_filter
+
+    def get_average(self, params, source=None, date_from=None, date_to=None, resolution='day'):
+        '''
+        Возвращает средние цены за квадратный метр по датам.
+        @param params: dict
+        @param source: str - источник данных (по умолчанию - из настроек)
+        @param date_from: datetime - начало интервала (включительно)
+        @param date_to: datetime - конец интервала (включительно)
+        @param resolution: str - day, week или month: за какой интервал считать средние
+            (дата - начало интервала)
+        @return: dict
+        '''
+        params['publication_date'] = self._get_date_filter(date_from, date_to)
+        series = self._get_series(params, source or settings.GRAPH_SOURCE, resolution=resolution)
+        return series.get(None, {})
+
+    def get_compared_average(self, params, by, source=None, date_from=None, date_to=None, resolution='day'):
+        '''
+        Возвращает средние цены за квадратный метр по датам для каждого значения поля by.
+        Все ряды получаются одним запросом.
+        @param params: dict
+        @param by: str - поле, по которому сравниваются ряды
+        @param source: str - источник данных (по умолчанию - из настроек)
+        @param date_from: datetime - начало интервала (включительно)
+        @param date_to: datetime - конец интервала (включительно)
+        @param resolution: str - day, week или month
+        @return: dict - значение поля by -> {дата: средняя цена}
+        '''
+        params['publication_date'] = self._get_date_filter(date_from, date_to)
+        return self._get_series(params, source or settings.GRAPH_SOURCE, by, resolution)
+
+    def build(self, params, source=None, width=None, height=None, resolution='day'):
         '''
         Строит график.
         @param params: dict
+        @param source: str - источник данных (по умолчанию - из настроек)
+        @param width: int - ширина картинки (по умолчанию - GraphDrawer.IMAGE_WIDTH)
+        @param height: int - высота картинки (по умолчанию - GraphDrawer.IMAGE_HEIGHT)
+        @param resolution: str - day, week или month
+        @return: str
+        '''
+        average = self.get_average(params, source, resolution=resolution)
+        return self._build_graph(average, params, width, height, resolution)
+
+    def build_comparison(self, params, by, source=None, width=None, height=None, resolution='day'):
+        '''
+        Строит сравнительный график: по ряду на каждое значение поля by.
+        @param params: dict
+        @param by: str - поле, по которому сравниваются ряды
+        @param source: str - источник данных (по умолчанию - из настроек)
+        @param width: int - ширина картинки (по умолчанию - GraphDrawer.IMAGE_WIDTH)
+        @param height: int - высота картинки (по умолчанию - GraphDrawer.IMAGE_HEIGHT)
+        @param resolution: str - day, week или month
         @return: str
         '''
-        adverts = self._get_adverts(params)
-        groupped = self._group_by_date(adverts)
-        average = self._get_groupped_average(groupped)
-        return self._build_graph(average, params)
+        series = self.get_compared_average(params, by, source, resolution=resolution)
+        return self._build_comparison_graph(series, params, by, width, height, resolution)
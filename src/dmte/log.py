@@ -1,6 +1,8 @@
 # encoding=utf8
 '''
 Логирование.
+Модули пишут в logger, а вывод настраивает точка входа (скрипт или приложение)
+вызовом setup_logging, а не импорт этого модуля.
 @author: Mic, 2012
 '''
 
@@ -8,11 +10,20 @@ from logging import Formatter, StreamHandler, getLogger, DEBUG, INFO
 
 from dmte.conf import settings
 
-formatter = Formatter('%(asctime)s [%(levelname)s] %(message)s')
+logger = getLogger()
 
-handler = StreamHandler()
-handler.setFormatter(formatter)
+# Настроен ли вывод в этом процессе:
+_configured = False
 
-logger = getLogger()
-logger.addHandler(handler)
-logger.setLevel(DEBUG if settings.DEBUG_LOG else INFO)
+def setup_logging():
+    '''
+    Настраивает вывод лога (один раз на процесс, повторные вызовы ничего не делают).
+    '''
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    handler = StreamHandler()
+    handler.setFormatter(Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(DEBUG if settings.DEBUG_LOG else INFO)
@@ -0,0 +1,289 @@
+# encoding=utf8
+'''
+Метрики: счетчики, значения и гистограммы времени в текстовом формате Prometheus.
+Метрики хранятся в памяти процесса.
+@author: Mic, 2012
+'''
+
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+import os
+
+# Границы корзин гистограмм времени (секунды):
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_value(value):
+    '''
+    Возвращает значение метрики строкой.
+    @param value: float
+    @return: str
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def _format_labels(labels):
+    '''
+    Возвращает метки в виде {name="value",...}.
+    @param labels: tuple - пары (имя, значение), отсортированные по имени
+    @return: str
+    '''
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(u'%s="%s"'%(name, value))
+    return u'{%s}'%u','.join(escaped)
+
+class Metric(object):
+    '''
+    Метрика с набором значений по меткам.
+    '''
+
+    # Тип метрики в формате Prometheus:
+    TYPE = None
+
+    def __init__(self, name, description, lock):
+        '''
+        @param name: str
+        @param description: str
+        @param lock: Lock - общая блокировка реестра
+        '''
+        self.name = name
+        self.description = description
+        self._lock = lock
+        self._values = {}
+
+    def _get_key(self, labels):
+        '''
+        Возвращает ключ значения по меткам.
+        @param labels: dict
+        @return: tuple
+        '''
+        return tuple(sorted(labels.items()))
+
+    def _get_sample_lines(self):
+        '''
+        Возвращает строки со значениями.
+        @return: list
+        '''
+        return [u'%s%s %s'%(self.name, _format_labels(key), _format_value(value))
+                for key, value in sorted(self._values.items())]
+
+    def get_lines(self):
+        '''
+        Возвращает описание и значения метрики строками.
+        @return: list
+        '''
+        with self._lock:
+            samples = self._get_sample_lines()
+        return [u'# HELP %s %s'%(self.name, self.description), u'# TYPE %s %s'%(self.name, self.TYPE)] + samples
+
+class Counter(Metric):
+    '''
+    Счетчик: только увеличивается.
+    '''
+
+    TYPE = 'counter'
+
+    def inc(self, value=1, **labels):
+        '''
+        Увеличивает счетчик.
+        @param value: float
+        '''
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+class Gauge(Metric):
+    '''
+    Значение, которое может как расти, так и уменьшаться.
+    '''
+
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        '''
+        Устанавливает значение.
+        @param value: float
+        '''
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    '''
+    Гистограмма: количество наблюдений по корзинам, их сумма и количество.
+    '''
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, lock, buckets=DEFAULT_BUCKETS):
+        '''
+        @param name: str
+        @param description: str
+        @param lock: Lock
+        @param buckets: tuple - верхние границы корзин
+        '''
+        super(Histogram, self).__init__(name, description, lock)
+        self._buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        '''
+        Добавляет наблюдение.
+        @param value: float
+        '''
+        key = self._get_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self._buckets), 0.0))
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Засчитывает время выполнения блока with.
+        '''
+        started = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - started, **labels)
+
+    def time_iterator(self, iterable, **labels):
+        '''
+        Перебирает iterable, засчитывая только время получения элементов
+        (одно наблюдение на весь перебор, когда он закончится).
+        @param iterable: iterable
+        @return: generator
+        '''
+        iterator = iter(iterable)
+        elapsed = 0
+        while True:
+            started = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time() - started
+                break
+            elapsed += time() - started
+            yield item
+        self.observe(elapsed, **labels)
+
+    def _get_sample_lines(self):
+        '''
+        Возвращает строки с корзинами, суммой и количеством наблюдений.
+        @return: list
+        '''
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self._buckets, counts):
+                labels = tuple(sorted(key + (('le', _format_value(bound)),)))
+                lines.append(u'%s_bucket%s %s'%(self.name, _format_labels(labels), count))
+            lines.append(u'%s_sum%s %s'%(self.name, _format_labels(key), _format_value(total)))
+            lines.append(u'%s_count%s %s'%(self.name, _format_labels(key), counts[-1]))
+        return lines
+
+class MetricsRegistry(object):
+    '''
+    Реестр метрик процесса.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = []
+
+    def _add(self, metric):
+        '''
+        Регистрирует метрику.
+        @param metric: Metric
+        @return: Metric
+        '''
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        '''
+        Регистрирует счетчик.
+        @param name: str
+        @param description: str
+        @return: Counter
+        '''
+        return self._add(Counter(name, description, self._lock))
+
+    def gauge(self, name, description):
+        '''
+        Регистрирует значение.
+        @param name: str
+        @param description: str
+        @return: Gauge
+        '''
+        return self._add(Gauge(name, description, self._lock))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        '''
+        Регистрирует гистограмму.
+        @param name: str
+        @param description: str
+        @param buckets: tuple
+        @return: Histogram
+        '''
+        return self._add(Histogram(name, description, self._lock, buckets))
+
+    def get_text(self, prefix=None):
+        '''
+        Возвращает метрики в текстовом формате Prometheus.
+        @param prefix: str или tuple - только метрики с таким началом имени
+        @return: str
+        '''
+        lines = []
+        for metric in self._metrics:
+            if prefix is None or metric.name.startswith(prefix):
+                lines.extend(metric.get_lines())
+        return (u'\n'.join(lines) + u'\n').encode('utf8')
+
+    def write(self, path, prefix=None):
+        '''
+        Записывает метрики в файл (через временный, чтобы читатели не увидели половину).
+        @param path: str
+        @param prefix: str или tuple - только метрики с таким началом имени
+        '''
+        temporary_path = '%s.%s.tmp'%(path, os.getpid())
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.get_text(prefix))
+        os.rename(temporary_path, path)
+
+# Реестр метрик процесса:
+metrics = MetricsRegistry()
+
+# Обход сайта:
+crawl_stage_seconds = metrics.histogram('dmte_crawl_stage_seconds',
+                                        'Time spent on a page by crawl stage (fetch, decode, parse, save).')
+crawl_pages = metrics.counter('dmte_crawl_pages_total', 'Pages fetched by the crawler.')
+crawl_received_bytes = metrics.counter('dmte_crawl_received_bytes_total', 'Bytes received by the crawler.')
+crawl_adverts = metrics.counter('dmte_crawl_adverts_total', 'Adverts seen by the crawler by result (new, changed, '
+                                'unchanged).')
+crawl_last_run_pages = metrics.gauge('dmte_crawl_last_run_pages', 'Pages parsed by the last crawl run.')
+crawl_last_run_new_adverts = metrics.gauge('dmte_crawl_last_run_new_adverts', 'New adverts found by the last crawl '
+                                           'run.')
+crawl_last_run_seconds = metrics.gauge('dmte_crawl_last_run_seconds', 'Duration of the last crawl run.')
+crawl_last_run_finished = metrics.gauge('dmte_crawl_last_run_finished_timestamp_seconds', 'When the last crawl run '
+                                        'finished.')
+
+# Графики:
+graph_stage_seconds = metrics.histogram('dmte_graph_stage_seconds', 'Time spent on a graph by stage (facets, query, '
+                                        'aggregation, render, encode).')
+graph_requests = metrics.counter('dmte_graph_requests_total', 'Graph and data requests by endpoint and result '
+                                 '(hit, miss, coalesced, not_modified, rejected, timeout).')
+
+# БД:
+mongo_clients_created = metrics.counter('dmte_mongo_clients_created_total', 'MongoDB clients created by this process '
+                                        '(one per process after fork).')
+mongo_pool_max_size = metrics.gauge('dmte_mongo_pool_max_size', 'Maximum size of the MongoDB connection pool of a '
+                                    'process.')
+mongo_connections = metrics.gauge('dmte_mongo_connections', 'MongoDB server connections by state (current, '
+                                  'available).')
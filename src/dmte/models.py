@@ -21,6 +21,58 @@ class Advert(object):
         self.room_count = None
         self.price = None
         self.publication_date = None
+        # Отпечаток сохраненных полей (см. AdvertProcessor.get_fingerprint):
+        self.fingerprint = None
         
     def __str__(self):
         return 'Advert(#%s)'%self.external_id
+
+class AdvertRollup(object):
+    '''
+    Сводка по объявлениям одной группы за один день.
+    '''
+
+    def __init__(self):
+        self.type = None
+        self.district = None
+        self.floor_number = None
+        self.room_count = None
+        self.publication_date = None
+        self.price = None
+        self.area = None
+        self.count = None
+
+    def __str__(self):
+        return 'AdvertRollup(%s, %s)'%(self.publication_date, self.count)
+
+class DataVersion(object):
+    '''
+    Версия данных.
+    '''
+
+    def __init__(self):
+        self.version = 0
+        self.updated = None
+
+    def __str__(self):
+        return 'DataVersion(%s)'%self.version
+
+class CrawlCheckpoint(object):
+    '''
+    Состояние обхода страниц: последняя полностью обработанная страница
+    (и все страницы до нее), адрес следующей и счетчики.
+    '''
+
+    def __init__(self):
+        self.run_id = None
+        self.new_only = False
+        self.last_url = None
+        self.next_url = None
+        self.page_count = 0
+        self.total_count = 0
+        self.started = None
+        self.updated = None
+        self.finished = False
+
+    def __str__(self):
+        return 'CrawlCheckpoint(%s, %s)'%(self.run_id, self.next_url)
@@ -4,29 +4,80 @@
 @author: Mic, 2012
 '''
 
-from pymongo import Connection
+from datetime import datetime
+from hashlib import md5
+from itertools import combinations, imap
+from struct import unpack
+import os
+
+from bson.binary import Binary
+from bson.son import SON
+from pymongo import ASCENDING, MongoClient, MongoReplicaSetClient, ReadPreference
+from pymongo.errors import AutoReconnect, ConnectionFailure, OperationFailure
 
 from dmte.conf import settings
-from dmte.models import Advert
+from dmte.metrics import mongo_clients_created
+from dmte.models import Advert, AdvertRollup, CrawlCheckpoint, DataVersion
 
 class MongoDb(object):
     '''
     Для работы с БД.
+    Клиент создается в том процессе, который с ним работает: подключения,
+    унаследованные через fork (uwsgi, multiprocessing), не используются.
     '''
+
+    # Предпочтения чтения по названиям из настроек:
+    READ_PREFERENCES = {
+        'primary': ReadPreference.PRIMARY,
+        'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+        'secondary': ReadPreference.SECONDARY,
+        'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+        'nearest': ReadPreference.NEAREST,
+    }
     
-    # Текущее подключение к БД:
-    _connection = None
+    # Текущий клиент БД и процесс, в котором он создан:
+    _client = None
+    _client_pid = None
+
+    # Предпочтение чтения для запросов процесса (None - из клиента, то есть с primary):
+    _read_preference = None
+
+    # БД, подставленная вместо настоящей:
+    _database = None
+
+    @classmethod
+    def _create_client(cls):
+        '''
+        Создает клиент БД по настройкам.
+        Для набора реплик нужен MongoReplicaSetClient: только он читает со вторичных серверов.
+        Подключение устанавливается при первом запросе.
+        @return: MongoClient
+        '''
+        options = settings.MONGO_DB
+        kwargs = {
+            'connect': False,
+            'max_pool_size': options['max_pool_size'],
+            'connectTimeoutMS': int(options['connect_timeout'] * 1000),
+            'socketTimeoutMS': int(options['socket_timeout'] * 1000),
+            'waitQueueTimeoutMS': int(options['wait_queue_timeout'] * 1000),
+        }
+        if options['replica_set']:
+            return MongoReplicaSetClient(options['host'], replicaSet=options['replica_set'], **kwargs)
+        return MongoClient(options['host'], options['port'], **kwargs)
     
     @classmethod
-    def _get_connection(cls):
+    def _get_client(cls):
         '''
-        Возвращает подключение к БД.
-        Если подключения еще нет, устанавливает его.
-        @return: Connection
+        Возвращает клиент БД.
+        Если клиента еще нет или он создан в другом процессе, создает новый.
+        @return: MongoClient
         '''
-        if cls._connection is None:
-            cls._connection = Connection(settings.MONGO_DB['host'], settings.MONGO_DB['port'])
-        return cls._connection
+        pid = os.getpid()
+        if cls._client is None or cls._client_pid != pid:
+            cls._client = cls._create_client()
+            cls._client_pid = pid
+            mongo_clients_created.inc()
+        return cls._client
     
     @classmethod
     def get(cls):
@@ -34,9 +85,222 @@ class MongoDb(object):
         Возвращает объект БД.
         @return: Database
         '''
-        connection = cls._get_connection()
+        if cls._database is not None:
+            return cls._database
+        client = cls._get_client()
         db_name = settings.MONGO_DB['db_name']
-        return connection[db_name]
+        return client.get_database(db_name, read_preference=cls._read_preference)
+
+    @classmethod
+    def use(cls, database):
+        '''
+        Подставляет другую БД вместо настоящей (например, для бенчмарков).
+        @param database: Database
+        '''
+        cls._database = database
+
+    @classmethod
+    def set_read_preference(cls, name):
+        '''
+        Задает, откуда читают все запросы процесса (например, графики - со вторичных серверов).
+        Запись всегда идет на primary.
+        @param name: str - название из READ_PREFERENCES
+        '''
+        cls._read_preference = cls.READ_PREFERENCES[name]
+
+    @classmethod
+    def get_pool_stats(cls):
+        '''
+        Возвращает сведения о подключениях: размер пула процесса и, если сервер
+        их отдает, количество открытых и доступных подключений к серверу.
+        @return: dict
+        '''
+        stats = {'max_pool_size': settings.MONGO_DB['max_pool_size']}
+        if cls._database is not None:
+            return stats
+        try:
+            connections = cls._get_client().admin.command('serverStatus')['connections']
+        except (AutoReconnect, ConnectionFailure, OperationFailure):
+            return stats
+        stats['current'] = connections['current']
+        stats['available'] = connections['available']
+        return stats
+
+def _get_plan_stages(plan):
+    '''
+    Возвращает названия всех стадий плана запроса.
+    Понимает как новый (stage), так и старый (cursor) формат explain.
+    @param plan: dict
+    @return: list
+    '''
+    stages = []
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key in ('stage', 'cursor') and isinstance(value, basestring):
+                stages.append(value)
+            elif key not in ('rejectedPlans', 'allPlans'):
+                stages.extend(_get_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_get_plan_stages(value))
+    return stages
+
+def _is_collection_scan(stages):
+    '''
+    Проверяет, есть ли в плане запроса полный просмотр коллекции.
+    @param stages: list
+    @return: bool
+    '''
+    return 'COLLSCAN' in stages or 'BasicCursor' in stages
+
+def _get_index_name(keys):
+    '''
+    Возвращает имя, которое MongoDB дает индексу по умолчанию.
+    @param keys: list - пары (поле, направление)
+    @return: str
+    '''
+    return '_'.join('%s_%s'%key for key in keys)
+
+def _get_index_names(plan):
+    '''
+    Возвращает имена индексов, которые использует план (без отвергнутых планов).
+    @param plan: dict
+    @return: list
+    '''
+    names = []
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'indexName' and isinstance(value, basestring):
+                names.append(value)
+            elif key not in ('rejectedPlans', 'allPlans'):
+                names.extend(_get_index_names(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            names.extend(_get_index_names(value))
+    return names
+
+def _get_plan_summary(plan):
+    '''
+    Возвращает индекс выигравшего плана, количество просмотренных ключей
+    и найденных документов (None, если explain их не вернул).
+    Понимает как новый (queryPlanner, executionStats), так и старый (cursor, nscanned, n) формат explain.
+    @param plan: dict
+    @return: str, int, int
+    '''
+    if 'queryPlanner' in plan:
+        names = sorted(set(_get_index_names(plan['queryPlanner'].get('winningPlan', {}))))
+        stats = plan.get('executionStats', {})
+        return ','.join(names) or None, stats.get('totalKeysExamined'), stats.get('nReturned')
+    cursor = plan.get('cursor', '').split()
+    index_name = cursor[1] if len(cursor) > 1 and cursor[0] == 'BtreeCursor' else None
+    return index_name, plan.get('nscanned'), plan.get('n')
+
+def _check_plan(plan, indexes, distinct_counts=None):
+    '''
+    Проверяет план запроса и возвращает описание проблемы или None.
+    Запрос должен идти по одному из ожидаемых индексов. Если известны количества
+    значений полей, лишних ключей должно быть не больше, чем дают поля индекса
+    между условиями на равенство и датой: на каждое сочетание их значений
+    приходится не больше двух ключей за границами интервала дат (и еще один в конце).
+    @param plan: dict
+    @param indexes: dict - имя ожидаемого индекса -> поля, пропускаемые перед датой
+    @param distinct_counts: dict - поле -> количество значений
+    @return: str
+    '''
+    if _is_collection_scan(_get_plan_stages(plan)):
+        return 'collection scan'
+    index_name, keys_examined, returned = _get_plan_summary(plan)
+    if index_name not in indexes:
+        return 'uses index %s instead of %s'%(index_name, ' or '.join(sorted(indexes)))
+    if distinct_counts is None or keys_examined is None or returned is None:
+        return None
+    combination_count = reduce(lambda count, field: count * distinct_counts[field], indexes[index_name], 1)
+    if keys_examined > returned + 2 * combination_count + 1:
+        return '%s keys examined for %s documents'%(keys_examined, returned)
+    return None
+
+class DataVersionProcessor(object):
+    '''
+    Версия данных: увеличивается каждый раз, когда меняются объявления.
+    По ней сбрасываются закэшированные значения.
+    '''
+
+    # Идентификатор документа с версией объявлений:
+    DOCUMENT_ID = 'adverts'
+
+    @property
+    def _collection(self):
+        '''
+        Возвращает коллекцию для версий.
+        @return: Collection
+        '''
+        return MongoDb.get().data_versions
+
+    def get(self):
+        '''
+        Возвращает текущую версию данных.
+        @return: DataVersion
+        '''
+        data_version = DataVersion()
+        document = self._collection.find_one({'_id': self.DOCUMENT_ID})
+        if document is not None:
+            data_version.version = document['version']
+            data_version.updated = document['updated']
+        return data_version
+
+    def bump(self):
+        '''
+        Увеличивает версию данных.
+        '''
+        self._collection.update({'_id': self.DOCUMENT_ID},
+                                {'$inc': {'version': 1}, '$set': {'updated': datetime.utcnow()}}, upsert=True)
+
+class CrawlCheckpointProcessor(object):
+    '''
+    Сохраненное состояние обхода страниц: по одному, последнего запуска, на каждый режим.
+    Так ежедневный обход новых объявлений не затирает прерванный полный обход.
+    '''
+
+    # Идентификаторы документов с состоянием обхода объявлений по режиму (new_only):
+    DOCUMENT_IDS = {
+        True: 'adverts:new',
+        False: 'adverts:all',
+    }
+
+    # Поля состояния:
+    FIELDS = ('run_id', 'new_only', 'last_url', 'next_url', 'page_count', 'total_count', 'started', 'updated',
+              'finished')
+
+    @property
+    def _collection(self):
+        '''
+        Возвращает коллекцию для состояний обхода.
+        @return: Collection
+        '''
+        return MongoDb.get().crawl_checkpoints
+
+    def get(self, new_only):
+        '''
+        Возвращает состояние последнего обхода в указанном режиме или None, если таких обходов не было.
+        @param new_only: bool
+        @return: CrawlCheckpoint
+        '''
+        document = self._collection.find_one({'_id': self.DOCUMENT_IDS[bool(new_only)]})
+        if document is None:
+            return None
+        checkpoint = CrawlCheckpoint()
+        for field in self.FIELDS:
+            setattr(checkpoint, field, document.get(field, getattr(checkpoint, field)))
+        return checkpoint
+
+    def save(self, checkpoint):
+        '''
+        Сохраняет состояние обхода.
+        @param checkpoint: CrawlCheckpoint
+        '''
+        checkpoint.updated = datetime.utcnow()
+        document = dict((field, getattr(checkpoint, field)) for field in self.FIELDS)
+        self._collection.update({'_id': self.DOCUMENT_IDS[bool(checkpoint.new_only)]}, {'$set': document}, upsert=True)
 
 class AdvertProcessor(object):
     
@@ -44,6 +308,38 @@ class AdvertProcessor(object):
     FIELDS = ('external_id', 'type', 'district', 'address', 'floor_number', 'floor_count', 
               'area', 'room_count', 'price', 'publication_date')
 
+    # Поля, по которым фильтруются графики:
+    GRAPH_FIELDS = ('type', 'district', 'floor_number', 'room_count')
+
+    # Индексы: поиск по внешнему идентификатору и составные индексы для графиков.
+    # Составные индексы - симметричное разбиение на цепочки всех 16 наборов фильтров:
+    # каждый набор в любом порядке совпадает с началом одного из индексов, так что
+    # условия на равенство не пропускают полей. Между ними и датой могут остаться
+    # другие поля индекса: тогда на каждое сочетание их значений просматриваются
+    # ключи на границах интервала дат (см. explain). Без фильтров используется индекс
+    # по дате, а каждое поле для distinct стоит первым хотя бы в одном индексе:
+    INDEXES = (
+        ([('external_id', ASCENDING)], {'unique': True}),
+        ([('type', ASCENDING), ('district', ASCENDING), ('room_count', ASCENDING),
+          ('floor_number', ASCENDING), ('publication_date', ASCENDING)], {}),
+        ([('type', ASCENDING), ('room_count', ASCENDING), ('floor_number', ASCENDING),
+          ('publication_date', ASCENDING)], {}),
+        ([('type', ASCENDING), ('floor_number', ASCENDING), ('district', ASCENDING),
+          ('publication_date', ASCENDING)], {}),
+        ([('district', ASCENDING), ('room_count', ASCENDING), ('floor_number', ASCENDING),
+          ('publication_date', ASCENDING)], {}),
+        ([('room_count', ASCENDING), ('floor_number', ASCENDING), ('publication_date', ASCENDING)], {}),
+        ([('floor_number', ASCENDING), ('district', ASCENDING), ('publication_date', ASCENDING)], {}),
+        ([('publication_date', ASCENDING)], {}),
+    )
+
+    # Поля, которые не нужны при сравнении сохраненных объявлений с новыми:
+    HISTORY_FIELDS = ('price_history',)
+
+    # Закэшированные значения полей и версия данных, для которой они получены:
+    _aggregated = None
+    _aggregated_version = None
+
     def _convert_advert_to_document(self, advert):
         '''
         Преобразовывает объявление в документ.
@@ -55,6 +351,7 @@ class AdvertProcessor(object):
             document['_id'] = advert.id
         for field_name in self.FIELDS:
             document[field_name] = getattr(advert, field_name)
+        document['fingerprint'] = self.get_fingerprint(advert)
         return document
     
     def _convert_document_to_advert(self, document):
@@ -66,10 +363,44 @@ class AdvertProcessor(object):
         if document is None:
             return None
         advert = Advert()
-        advert.id = document['_id']
+        advert.id = document.get('_id')
         for field_name in self.FIELDS:
-            setattr(advert, field_name, document[field_name])
+            if field_name in document:
+                setattr(advert, field_name, document[field_name])
+        advert.fingerprint = document.get('fingerprint')
         return advert
+
+    def get_fingerprint(self, advert):
+        '''
+        Возвращает отпечаток сохраняемых полей объявления: 64-битное число.
+        @param advert: Advert
+        @return: int
+        '''
+        values = repr(tuple(getattr(advert, field_name) for field_name in self.FIELDS))
+        return unpack('<q', md5(values).digest()[:8])[0]
+
+    def get_changed(self, adverts, stored):
+        '''
+        Возвращает новые и изменившиеся объявления: те, чей отпечаток
+        не совпадает с отпечатком сохраненного.
+        @param adverts: list
+        @param stored: dict - сохраненные объявления по внешнему идентификатору
+        @return: list
+        '''
+        changed = []
+        for advert in adverts:
+            stored_advert = stored.get(advert.external_id)
+            if stored_advert is None or stored_advert.fingerprint != self.get_fingerprint(advert):
+                changed.append(advert)
+        return changed
+
+    def _get_price_change(self, advert):
+        '''
+        Возвращает запись истории цены объявления.
+        @param advert: Advert
+        @return: dict
+        '''
+        return {'date': datetime.utcnow(), 'price': advert.price}
     
     @property
     def _collection(self):
@@ -78,10 +409,84 @@ class AdvertProcessor(object):
         @return: Collection
         '''
         return MongoDb.get().adverts
+
+    def ensure_indexes(self):
+        '''
+        Создает индексы, которых еще нет.
+        '''
+        for keys, options in self.INDEXES:
+            self._collection.ensure_index(keys, **options)
+
+    def _get_graph_indexes(self, fields):
+        '''
+        Возвращает индексы, которые подходят для поиска по полям графика и дате:
+        поля в каком-то порядке составляют начало индекса, дальше в нем есть дата.
+        @param fields: tuple
+        @return: dict - имя индекса -> поля между условиями на равенство и датой
+        '''
+        indexes = {}
+        for keys, _ in self.INDEXES:
+            names = [name for name, _ in keys]
+            if set(names[:len(fields)]) == set(fields) and 'publication_date' in names[len(fields):]:
+                indexes[_get_index_name(keys)] = names[len(fields):names.index('publication_date')]
+        return indexes
+
+    def _explain_find(self, spec, indexes, distinct_counts=None):
+        '''
+        Возвращает стадии плана для поиска и описание проблемы с ним (или None).
+        @param spec: dict
+        @param indexes: dict - ожидаемые индексы (см. _check_plan)
+        @param distinct_counts: dict
+        @return: list, str
+        '''
+        plan = self._collection.find(spec).explain()
+        return _get_plan_stages(plan), _check_plan(plan, indexes, distinct_counts)
+
+    def _explain_distinct(self, field):
+        '''
+        Возвращает стадии плана для distinct и описание проблемы с ним (или None).
+        @param field: str
+        @return: list, str
+        '''
+        command = SON([('distinct', self._collection.name), ('key', field)])
+        try:
+            plan = self._collection.database.command('explain', command)
+        except OperationFailure as e:
+            return ['unavailable: %s'%e], None
+        indexes = dict((_get_index_name(keys), []) for keys, _ in self.INDEXES if keys[0][0] == field)
+        return _get_plan_stages(plan), _check_plan(plan, indexes)
+
+    def explain(self):
+        '''
+        Возвращает планы всех запросов, которые выполняет процессор:
+        список из описания запроса, стадий плана и описания проблемы (None, если план
+        хороший: запрос идет по ожидаемому индексу и не просматривает лишних ключей).
+        @return: list
+        '''
+        sample = self._collection.find_one() or {}
+        distinct_counts = dict((field, len(self._collection.distinct(field))) for field in self.GRAPH_FIELDS)
+        plans = []
+        external_id = sample.get('external_id', '0')
+        external_id_index = _get_index_name(self.INDEXES[0][0])
+        plans.append(('get_by_external_id',) + self._explain_find({'external_id': external_id},
+                                                                  {external_id_index: []}, distinct_counts))
+        for count in range(len(self.GRAPH_FIELDS) + 1):
+            for fields in combinations(self.GRAPH_FIELDS, count):
+                spec = dict((field, sample.get(field)) for field in fields)
+                spec['publication_date'] = {'$gt': sample.get('publication_date')}
+                name = 'get_by_info(%s)'%', '.join(fields + ('publication_date',))
+                indexes = self._get_graph_indexes(fields)
+                if not indexes:
+                    plans.append((name, [], 'no index starts with these fields'))
+                    continue
+                plans.append((name,) + self._explain_find(spec, indexes, distinct_counts))
+        for field in self.GRAPH_FIELDS:
+            plans.append(('distinct(%s)'%field,) + self._explain_distinct(field))
+        return plans
     
-    def get_aggregated(self):
+    def _get_aggregated(self):
         '''
-        Возвращает все возможные значения для полей.
+        Возвращает все возможные значения для полей из БД.
         @return: dict
         '''
         aggregated = {}
@@ -91,6 +496,19 @@ class AdvertProcessor(object):
         aggregated['floor_number'] = filter(lambda value: value <= 10, aggregated['floor_number'])
         aggregated['room_count'] = filter(lambda value: value <= 5, aggregated['room_count'])
         return aggregated
+
+    def get_aggregated(self):
+        '''
+        Возвращает все возможные значения для полей.
+        Значения кэшируются в памяти процесса до изменения версии данных.
+        @return: dict
+        '''
+        version = DataVersionProcessor().get().version
+        cls = type(self)
+        if cls._aggregated is None or cls._aggregated_version != version:
+            cls._aggregated = self._get_aggregated()
+            cls._aggregated_version = version
+        return cls._aggregated
     
     def get_by_external_id(self, external_id):
         '''
@@ -100,20 +518,325 @@ class AdvertProcessor(object):
         '''
         document = self._collection.find_one({'external_id': external_id})
         return self._convert_document_to_advert(document)
+
+    def get_by_external_ids(self, external_ids):
+        '''
+        Находит объявления по списку внешних идентификаторов.
+        @param external_ids: list
+        @return: dict
+        '''
+        projection = dict((field_name, False) for field_name in self.HISTORY_FIELDS)
+        documents = self._collection.find({'external_id': {'$in': list(external_ids)}}, projection)
+        adverts = map(self._convert_document_to_advert, documents)
+        return dict((advert.external_id, advert) for advert in adverts)
     
-    def get_by_info(self, params):
+    def get_by_info(self, params, fields=None, batch_size=None):
         '''
-        Возвращает список объявлений по указанным параметрам.
+        Возвращает объявления по указанным параметрам.
+        Объявления читаются из курсора по мере перебора, пачками по batch_size.
+        Если указаны поля, из БД загружаются только они (без идентификатора),
+        остальные атрибуты объявления остаются пустыми.
         @param params: dict
-        @return: list
+        @param fields: list
+        @param batch_size: int
+        @return: iterator
         '''
-        documents = self._collection.find(params)
-        return map(self._convert_document_to_advert, documents)
+        projection = None
+        if fields is not None:
+            projection = dict((field_name, True) for field_name in fields)
+            projection['_id'] = False
+        documents = self._collection.find(params, projection)
+        if batch_size is not None:
+            documents = documents.batch_size(batch_size)
+        return imap(self._convert_document_to_advert, documents)
     
+    def get_groupped_by_date(self, params, fix_ratio, by=None):
+        '''
+        Возвращает суммы цен и площадей объявлений по датам, посчитанные в БД.
+        Если указано поле by, суммы считаются отдельно для каждого его значения.
+        Объявления, у которых отношение цены квадратного метра к средней по группе
+        выходит за пределы (1 / fix_ratio, fix_ratio), не учитываются.
+        @param params: dict
+        @param fix_ratio: float
+        @param by: str
+        @return: list - кортежи (значение поля by или None, дата, сумма цен, сумма площадей)
+        '''
+        group_id = {'publication_date': '$publication_date'}
+        if by is not None:
+            group_id['value'] = '$%s'%by
+        pipeline = [
+            {'$match': params},
+            {'$group': {
+                '_id': group_id,
+                'price': {'$sum': '$price'},
+                'area': {'$sum': '$area'},
+                'adverts': {'$push': {'price': '$price', 'area': '$area'}},
+            }},
+            {'$unwind': '$adverts'},
+            {'$project': {
+                'advert_price': '$adverts.price',
+                'advert_area': '$adverts.area',
+                'ratio': {'$divide': [{'$divide': ['$adverts.price', '$adverts.area']},
+                                      {'$divide': ['$price', '$area']}]},
+            }},
+            {'$match': {'ratio': {'$gt': 1 / fix_ratio, '$lt': fix_ratio}}},
+            {'$group': {'_id': '$_id', 'price': {'$sum': '$advert_price'}, 'area': {'$sum': '$advert_area'}}},
+        ]
+        result = self._collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            result = result['result']
+        return [(document['_id'].get('value'), document['_id']['publication_date'], document['price'], document['area'])
+                for document in result]
+
     def save(self, advert):
         '''
         Сохраняет объявление в БД.
         @param advert: Advert
         '''
         document = self._convert_advert_to_document(advert)
+        document['price_history'] = [self._get_price_change(advert)]
         advert.id = self._collection.insert(document)
+
+    def save_many(self, adverts, stored=None):
+        '''
+        Сохраняет пачку объявлений в БД одним запросом.
+        Объявления сопоставляются по внешнему идентификатору. Если цена нового
+        объявления отличается от сохраненной (или объявления еще не было),
+        в историю цены дописывается запись.
+        Возвращает количество новых объявлений.
+        @param adverts: list
+        @param stored: dict - сохраненные объявления по внешнему идентификатору
+        @return: int
+        '''
+        adverts = list(adverts)
+        if not adverts:
+            return 0
+        stored = stored or {}
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for advert in adverts:
+            document = self._convert_advert_to_document(advert)
+            document.pop('_id', None)
+            update = {'$set': document}
+            stored_advert = stored.get(advert.external_id)
+            if stored_advert is None or stored_advert.price != advert.price:
+                update['$push'] = {'price_history': self._get_price_change(advert)}
+            bulk.find({'external_id': advert.external_id}).upsert().update_one(update)
+        result = bulk.execute()
+        for upserted in result['upserted']:
+            adverts[upserted['index']].id = upserted['_id']
+        return result['nUpserted']
+
+class AdvertRollupProcessor(object):
+    '''
+    Сводка по объявлениям: суммы цен и площадей и количество объявлений
+    для каждой группы за каждый день.
+    '''
+
+    # Поля, по которым группируются объявления:
+    KEY_FIELDS = ('type', 'district', 'floor_number', 'room_count', 'publication_date')
+
+    # Поля, в которых накапливаются суммы:
+    SUM_FIELDS = ('price', 'area', 'count')
+
+    # Индексы: уникальный ключ группы для обновлений и дата для графиков без фильтров:
+    INDEXES = (
+        ([(field_name, ASCENDING) for field_name in KEY_FIELDS], {'unique': True}),
+        ([('publication_date', ASCENDING)], {}),
+    )
+
+    def _convert_document_to_rollup(self, document):
+        '''
+        Преобразовывает документ в сводку.
+        @param document: dict
+        @return: AdvertRollup
+        '''
+        rollup = AdvertRollup()
+        for field_name in self.KEY_FIELDS + self.SUM_FIELDS:
+            setattr(rollup, field_name, document[field_name])
+        return rollup
+
+    @property
+    def _collection(self):
+        '''
+        Возвращает коллекцию для сводок.
+        @return: Collection
+        '''
+        return MongoDb.get().advert_rollups
+
+    def ensure_indexes(self):
+        '''
+        Создает индексы, которых еще нет.
+        '''
+        for keys, options in self.INDEXES:
+            self._collection.ensure_index(keys, **options)
+
+    def explain(self):
+        '''
+        Возвращает планы запросов графиков к сводке: список из описания запроса,
+        стадий плана и описания проблемы (None, если коллекция не просматривается целиком).
+        Сводка маленькая, поэтому конкретные индексы для нее не проверяются.
+        @return: list
+        '''
+        sample = self._collection.find_one() or {}
+        plans = []
+        fields = AdvertProcessor.GRAPH_FIELDS
+        for count in range(len(fields) + 1):
+            for selected in combinations(fields, count):
+                spec = dict((field, sample.get(field)) for field in selected)
+                spec['publication_date'] = {'$gt': sample.get('publication_date')}
+                spec['count'] = {'$gt': 0}
+                stages = _get_plan_stages(self._collection.find(spec).explain())
+                name = 'rollup.get_by_info(%s)'%', '.join(selected + ('publication_date',))
+                plans.append((name, stages, 'collection scan' if _is_collection_scan(stages) else None))
+        return plans
+
+    def _get_key(self, advert):
+        '''
+        Возвращает ключ группы, в которую попадает объявление.
+        @param advert: Advert
+        @return: tuple
+        '''
+        return tuple(getattr(advert, field_name) for field_name in self.KEY_FIELDS)
+
+    def _add_to_deltas(self, deltas, advert, sign):
+        '''
+        Добавляет объявление к изменениям сводки с нужным знаком.
+        @param deltas: dict
+        @param advert: Advert
+        @param sign: int
+        '''
+        key = self._get_key(advert)
+        if key not in deltas:
+            deltas[key] = [0, 0, 0]
+        delta = deltas[key]
+        delta[0] += sign * advert.price
+        delta[1] += sign * advert.area
+        delta[2] += sign
+
+    def _get_deltas(self, stored, adverts):
+        '''
+        Возвращает изменения сводки: вклад сохраненных ранее версий объявлений
+        вычитается, вклад новых версий добавляется.
+        Группы, которые не изменились, в результат не попадают.
+        @param stored: list
+        @param adverts: list
+        @return: dict
+        '''
+        deltas = {}
+        for advert in stored:
+            self._add_to_deltas(deltas, advert, -1)
+        unique = dict((advert.external_id, advert) for advert in adverts)
+        for advert in unique.values():
+            self._add_to_deltas(deltas, advert, 1)
+        return dict((key, delta) for key, delta in deltas.items() if any(delta))
+
+    def _apply_deltas(self, deltas):
+        '''
+        Записывает изменения сводки в БД одним запросом.
+        @param deltas: dict
+        '''
+        if not deltas:
+            return
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for key, delta in deltas.items():
+            spec = dict(zip(self.KEY_FIELDS, key))
+            increments = dict(zip(self.SUM_FIELDS, delta))
+            bulk.find(spec).upsert().update_one({'$inc': increments})
+        bulk.execute()
+
+    def update(self, stored, adverts):
+        '''
+        Обновляет сводку после сохранения объявлений.
+        Возвращает количество измененных групп.
+        @param stored: list - версии объявлений, которые были в БД до сохранения
+        @param adverts: list - сохраненные объявления
+        @return: int
+        '''
+        deltas = self._get_deltas(stored, adverts)
+        self._apply_deltas(deltas)
+        return len(deltas)
+
+    def rebuild(self):
+        '''
+        Заново строит сводку по всем объявлениям.
+        Возвращает количество групп.
+        @return: int
+        '''
+        processor = AdvertProcessor()
+        deltas = self._get_deltas([], processor.get_by_info({}))
+        self._collection.drop()
+        self.ensure_indexes()
+        self._apply_deltas(deltas)
+        return len(deltas)
+
+    def ensure_built(self):
+        '''
+        Строит сводку, если она пуста, а объявления уже есть: например, при первом
+        обходе после обновления или после удаления коллекции.
+        Возвращает количество групп или None, если сводка не перестраивалась.
+        @return: int
+        '''
+        if self._collection.find_one() is not None or AdvertProcessor()._collection.find_one() is None:
+            return None
+        return self.rebuild()
+
+    def get_by_info(self, params):
+        '''
+        Возвращает список сводок по указанным параметрам.
+        @param params: dict
+        @return: list
+        '''
+        spec = dict(params, count={'$gt': 0})
+        documents = self._collection.find(spec)
+        return map(self._convert_document_to_rollup, documents)
+
+class GraphCacheProcessor(object):
+    '''
+    Кэш построенных графиков.
+    График хранится вместе с версией данных, по которой он построен,
+    и считается устаревшим, как только версия меняется.
+    '''
+
+    @classmethod
+    def get_key(cls, params, options=()):
+        '''
+        Возвращает ключ графика по его параметрам.
+        Ключ собирается в unicode и кодируется в UTF-8 один раз, так что
+        параметры из адреса могут быть не только латиницей.
+        @param params: dict
+        @param options: list - пары (имя, значение), дописываемые в ключ после параметров в том же порядке
+        @return: str
+        '''
+        items = sorted((unicode(key), unicode(value)) for key, value in params.items())
+        items.extend((unicode(key), unicode(value)) for key, value in options)
+        return u';'.join(u'%s=%s'%item for item in items).encode('utf8')
+
+    @property
+    def _collection(self):
+        '''
+        Возвращает коллекцию для графиков.
+        @return: Collection
+        '''
+        return MongoDb.get().graphs
+
+    def get(self, key, version):
+        '''
+        Возвращает график, построенный по указанной версии данных, или None.
+        @param key: str
+        @param version: int
+        @return: str
+        '''
+        document = self._collection.find_one({'_id': key, 'version': version})
+        if document is None:
+            return None
+        return str(document['body'])
+
+    def save(self, key, version, body):
+        '''
+        Сохраняет график.
+        @param key: str
+        @param version: int
+        @param body: str
+        '''
+        document = {'version': version, 'body': Binary(body), 'created': datetime.utcnow()}
+        self._collection.update({'_id': key}, {'$set': document}, upsert=True)
@@ -0,0 +1,104 @@
+# encoding=utf8
+'''
+Выборочное профилирование: часть вызовов выполняется под cProfile,
+профили пишутся в каталог. Включается в настройках (PROFILING) или переменной
+окружения DMTE_PROFILE (доля профилируемых вызовов, например 0.01).
+@author: Mic, 2012
+'''
+
+from cProfile import Profile
+from datetime import datetime
+from functools import wraps
+from itertools import count
+from random import random
+from threading import Lock
+from time import time
+import os
+
+from dmte.conf import settings
+from dmte.log import logger
+
+def get_sample_rate():
+    '''
+    Возвращает долю профилируемых вызовов: из переменной окружения DMTE_PROFILE,
+    а если ее нет - из настроек (0, если профилирование выключено).
+    @return: float
+    '''
+    value = os.environ.get('DMTE_PROFILE')
+    if value:
+        try:
+            return min(max(float(value), 0.0), 1.0)
+        except ValueError:
+            logger.warning('bad DMTE_PROFILE value %r, profiling is off', value)
+            return 0.0
+    if not settings.PROFILING['enabled']:
+        return 0.0
+    return settings.PROFILING['sample_rate']
+
+class ProfileWriter(object):
+    '''
+    Запись профилей в каталог: файл .prof на каждый профиль и индекс, в который
+    дописывается строка "время<TAB>вид<TAB>длительность<TAB>файл<TAB>описание".
+    '''
+
+    # Формат времени в индексе и именах файлов:
+    DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    # Номера профилей в процессе (общие для всех писателей, чтобы имена не совпадали):
+    _numbers = count(1)
+    _lock = Lock()
+
+    def __init__(self, path):
+        '''
+        @param path: str - каталог профилей
+        '''
+        self._path = path
+
+    def write(self, profile, kind, seconds, description):
+        '''
+        Сохраняет профиль.
+        @param profile: Profile
+        @param kind: str - что профилировалось (graph, page)
+        @param seconds: float
+        @param description: str - параметры запроса или адрес
+        '''
+        now = datetime.utcnow().strftime(self.DATETIME_FORMAT)
+        with self._lock:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+            file_name = '%s-%s-%s-%s.prof'%(kind, now, os.getpid(), next(self._numbers))
+            profile.dump_stats(os.path.join(self._path, file_name))
+            if isinstance(description, unicode):
+                description = description.encode('utf8')
+            description = description.replace('\t', ' ').replace('\n', ' ')
+            with open(os.path.join(self._path, 'index.tsv'), 'a') as index_file:
+                index_file.write('%s\t%s\t%.3f\t%s\t%s\n'%(now, kind, seconds, file_name, description))
+
+def profiled(kind, describe):
+    '''
+    Декоратор: выполняет часть вызовов функции под профилировщиком.
+    Если профилирование выключено, функция возвращается как есть и ничего не стоит.
+    @param kind: str - что профилируется (graph, page)
+    @param describe: callable - аргументы вызова -> описание для индекса
+    @return: callable
+    '''
+    sample_rate = get_sample_rate()
+    if not sample_rate:
+        return lambda function: function
+    writer = ProfileWriter(settings.PROFILING['path'])
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if random() >= sample_rate:
+                return function(*args, **kwargs)
+            profile = Profile()
+            started = time()
+            try:
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                try:
+                    writer.write(profile, kind, time() - started, describe(*args, **kwargs))
+                except Exception:
+                    logger.exception('can not write %s profile', kind)
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+# encoding=utf8
+'''
+Построение графиков вне потоков, обслуживающих запросы.
+@author: Mic, 2012
+'''
+
+from Queue import Queue
+from threading import Event, Lock, Thread
+import os
+
+from dmte.log import logger
+
+class RenderPoolFull(Exception):
+    '''
+    В очереди на построение нет места.
+    '''
+
+class RenderTimeout(Exception):
+    '''
+    График не построен за отведенное время.
+    '''
+
+class RenderCall(object):
+    '''
+    Построение одного графика: результат ждут все запросы с тем же ключом.
+    '''
+
+    def __init__(self, function):
+        '''
+        @param function: callable - строит график
+        '''
+        self._function = function
+        self._done = Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        '''
+        Строит график и будит ожидающих.
+        '''
+        try:
+            self._result = self._function()
+        except Exception as e:
+            logger.exception('can not render graph')
+            self._error = e
+        finally:
+            self._done.set()
+
+    def wait(self, timeout):
+        '''
+        Ждет и возвращает результат построения.
+        Если построение упало, исключение выбрасывается в каждом ожидающем.
+        @param timeout: float - секунды
+        @return: mixed
+        '''
+        if not self._done.wait(timeout):
+            raise RenderTimeout('graph is not rendered in %ss'%timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class RenderPool(object):
+    '''
+    Ограниченный пул потоков для построения графиков.
+    Одинаковые построения, которые уже идут или ждут очереди, не повторяются:
+    новый запрос получает уже созданный RenderCall. Если построений больше,
+    чем потоков и мест в очереди, новые сразу отклоняются.
+    Потоки запускаются при первом построении в процессе (после fork в uwsgi).
+    '''
+
+    def __init__(self, worker_count, queue_size):
+        '''
+        @param worker_count: int - количество потоков
+        @param queue_size: int - сколько построений может ждать свободного потока
+        '''
+        self._worker_count = worker_count
+        self._queue_size = queue_size
+        self._lock = Lock()
+        self._queue = Queue()
+        self._calls = {}
+        self._pid = None
+
+    def _start(self):
+        '''
+        Запускает потоки, если в этом процессе их еще нет.
+        Вызывается под блокировкой.
+        '''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._calls = {}
+        for _ in range(self._worker_count):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        '''
+        Выполняет построения из очереди.
+        '''
+        while True:
+            key, call = self._queue.get()
+            try:
+                call.run()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+
+    def submit(self, key, function):
+        '''
+        Ставит построение в очередь (или присоединяется к такому же) и возвращает его
+        вместе с признаком того, что оно уже было.
+        @param key: str
+        @param function: callable
+        @return: RenderCall, bool
+        '''
+        with self._lock:
+            self._start()
+            call = self._calls.get(key)
+            if call is not None:
+                return call, True
+            if len(self._calls) >= self._worker_count + self._queue_size:
+                raise RenderPoolFull('%s renders pending'%len(self._calls))
+            call = RenderCall(function)
+            self._calls[key] = call
+            self._queue.put((key, call))
+            return call, False
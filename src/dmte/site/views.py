@@ -4,14 +4,35 @@
 @author: Mic, 2012
 '''
 
-from flask import Flask, make_response, request, render_template, url_for
+from datetime import datetime
+from functools import partial
+from hashlib import md5
+import json
+
+from flask import Flask, Response, abort, make_response, request, render_template, url_for
+from werkzeug.http import is_resource_modified
 
 from dmte.conf import settings
-from dmte.graphics import GraphBuilder
-from dmte.processors import AdvertProcessor
+from dmte.graphics import GraphBuilder, GraphDrawer
+from dmte.log import setup_logging
+from dmte.metrics import graph_requests, graph_stage_seconds, metrics, mongo_connections, mongo_pool_max_size
+from dmte.profiling import profiled
+from dmte.processors import AdvertProcessor, DataVersionProcessor, GraphCacheProcessor, MongoDb
+from dmte.site.rendering import RenderPool, RenderPoolFull, RenderTimeout
+
+setup_logging()
 
 app = Flask(__name__)
 
+MongoDb.set_read_preference(settings.MONGO_DB['graph_read_preference'])
+
+# Размеры картинки, которые можно запросить (кроме размера по умолчанию):
+_allowed_sizes = frozenset((width, height) for width, height in settings.GRAPH_IMAGE['sizes']
+                           if GraphDrawer.is_valid_size(width, height))
+
+# Пул для построения графиков:
+render_pool = RenderPool(settings.RENDER_POOL['workers'], settings.RENDER_POOL['queue_size'])
+
 @app.route('/')
 def index():
     '''
@@ -43,7 +64,8 @@ def _validate_graph_params(params):
     Проверяет параметры графика.
     '''
     processor = AdvertProcessor()
-    aggregated = processor.get_aggregated()
+    with graph_stage_seconds.time(stage='facets'):
+        aggregated = processor.get_aggregated()
     if not _validate_graph_param(aggregated, params, 'type', 'all'):
         return False
     if not _validate_graph_param(aggregated, params, 'district', 'all'):
@@ -54,15 +76,241 @@ def _validate_graph_params(params):
         return False
     return True
 
+def _get_etag(key, data_version):
+    '''
+    Возвращает ETag ответа: хэш ключа и версия данных.
+    @param key: str
+    @param data_version: DataVersion
+    @return: str
+    '''
+    return '%s-%s'%(md5(key).hexdigest(), data_version.version)
+
+def _set_validators(response, etag, data_version):
+    '''
+    Проставляет ответу ETag и Last-Modified и просит клиентов проверять их при каждом запросе.
+    @param response: Response
+    @param etag: str
+    @param data_version: DataVersion
+    @return: Response
+    '''
+    response.set_etag(etag)
+    response.last_modified = data_version.updated
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+@profiled('graph', lambda key, version, build, url: url)
+def _render_graph(key, version, build, url):
+    '''
+    Строит график и сохраняет его в кэш (в потоке пула).
+    Кэш проверяется еще раз: пока построение ждало в очереди, график могли сохранить.
+    @param key: str
+    @param version: int
+    @param build: callable - строит график
+    @param url: str - адрес запроса (для профиля)
+    @return: str
+    '''
+    cache = GraphCacheProcessor()
+    graph = cache.get(key, version)
+    if graph is None:
+        graph = build()
+        cache.save(key, version, graph)
+    return graph
+
+def _get_graph(key, version, build):
+    '''
+    Возвращает график из кэша, а если его там нет - строит в пуле и сохраняет в кэш.
+    Одновременные запросы одного графика ждут одного построения.
+    @param key: str
+    @param version: int
+    @param build: callable - строит график
+    @return: str
+    '''
+    cache = GraphCacheProcessor()
+    graph = cache.get(key, version)
+    if graph is not None:
+        graph_requests.inc(endpoint=request.endpoint, result='hit')
+        return graph
+    call, coalesced = render_pool.submit('%s@%s'%(key, version),
+                                         partial(_render_graph, key, version, build, request.url))
+    graph_requests.inc(endpoint=request.endpoint, result='coalesced' if coalesced else 'miss')
+    return call.wait(settings.RENDER_POOL['timeout'])
+
+def _get_unavailable_response():
+    '''
+    Возвращает ответ "сервис перегружен, повторите позже".
+    @return: Response
+    '''
+    response = make_response('', 503)
+    response.headers['Retry-After'] = str(settings.RENDER_POOL['retry_after'])
+    return response
+
+def _get_graph_response(key, build):
+    '''
+    Возвращает ответ с графиком или 304, если у клиента актуальная версия.
+    @param key: str
+    @param build: callable - строит график
+    @return: Response
+    '''
+    data_version = DataVersionProcessor().get()
+    etag = _get_etag(key, data_version)
+    if not is_resource_modified(request.environ, etag, last_modified=data_version.updated):
+        graph_requests.inc(endpoint=request.endpoint, result='not_modified')
+        response = make_response('', 304)
+    else:
+        try:
+            graph = _get_graph(key, data_version.version, build)
+        except RenderPoolFull:
+            graph_requests.inc(endpoint=request.endpoint, result='rejected')
+            return _get_unavailable_response()
+        except RenderTimeout:
+            graph_requests.inc(endpoint=request.endpoint, result='timeout')
+            return _get_unavailable_response()
+        response = make_response(graph)
+        response.mimetype = 'image/png'
+    return _set_validators(response, etag, data_version)
+
+def _get_size_args():
+    '''
+    Возвращает размер картинки из параметров запроса width и height
+    (None - размер по умолчанию).
+    Допускаются только размеры из настроек: иначе каждый новый размер
+    строился бы и навсегда оставался в кэше графиков.
+    @return: int, int
+    '''
+    try:
+        width = int(request.args.get('width') or GraphDrawer.IMAGE_WIDTH)
+        height = int(request.args.get('height') or GraphDrawer.IMAGE_HEIGHT)
+    except ValueError:
+        abort(400)
+    if (width, height) == (GraphDrawer.IMAGE_WIDTH, GraphDrawer.IMAGE_HEIGHT):
+        return None, None
+    if (width, height) not in _allowed_sizes:
+        abort(400)
+    return width, height
+
+def _get_resolution_arg():
+    '''
+    Возвращает интервал группировки точек из параметра запроса resolution (day, week или month).
+    @return: str
+    '''
+    resolution = request.args.get('resolution') or 'day'
+    if resolution not in GraphBuilder.RESOLUTIONS:
+        abort(400)
+    return resolution
+
+def _get_graph_options():
+    '''
+    Возвращает параметры картинки из запроса (размер и интервал группировки точек)
+    и пары (имя, значение) для ключа кэша, отвечающие за них.
+    @return: dict, list
+    '''
+    width, height = _get_size_args()
+    resolution = _get_resolution_arg()
+    key_options = []
+    if width is not None:
+        key_options.append(('size', '%sx%s'%(width, height)))
+    if resolution != 'day':
+        key_options.append(('resolution', resolution))
+    return {'width': width, 'height': height, 'resolution': resolution}, key_options
+
 @app.route('/graph/<type>/<district>/<int:floor_number>/<int:room_count>/')
 def graph(**kwargs):
     '''
     Генератор графиков.
+    Размер картинки задается параметрами width и height, интервал группировки точек - resolution.
     '''
     if not _validate_graph_params(kwargs):
         return None, 404
+    options, key_options = _get_graph_options()
+    key = GraphCacheProcessor.get_key(kwargs, key_options)
+    return _get_graph_response(key, lambda: GraphBuilder().build(kwargs, **options))
+
+@app.route('/compare/<by>/<type>/<district>/<int:floor_number>/<int:room_count>/')
+def compare(by, **kwargs):
+    '''
+    Сравнительный график: по ряду на каждое значение параметра by.
+    Сравниваемый параметр в адресе должен быть "любым" (all или 0).
+    Размер картинки задается параметрами width и height, интервал группировки точек - resolution.
+    '''
+    if by not in GraphBuilder.COMPARE_LEGENDS or not _validate_graph_params(kwargs) or by in kwargs:
+        abort(404)
+    options, key_options = _get_graph_options()
+    key = GraphCacheProcessor.get_key(kwargs, [('compare', by)] + key_options)
+    return _get_graph_response(key, lambda: GraphBuilder().build_comparison(kwargs, by, **options))
+
+def _get_date_arg(name):
+    '''
+    Возвращает дату из параметра запроса (ГГГГ-ММ-ДД) или None.
+    @param name: str
+    @return: datetime
+    '''
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+def _get_csv_lines(rows):
+    '''
+    Возвращает строки CSV по одной.
+    @param rows: list
+    @return: generator
+    '''
+    yield 'date,price\r\n'
+    for publication_date, value in rows:
+        yield '%s,%.2f\r\n'%(publication_date.strftime('%Y-%m-%d'), value)
+
+@app.route('/data/<type>/<district>/<int:floor_number>/<int:room_count>/')
+def data(**kwargs):
+    '''
+    Средние цены за квадратный метр по датам: JSON (по умолчанию) или CSV (?format=csv).
+    Интервал задается параметрами from и to (ГГГГ-ММ-ДД, включительно),
+    интервал группировки (day, week или month) - параметром resolution.
+    '''
+    if not _validate_graph_params(kwargs):
+        abort(404)
+    data_format = request.args.get('format', 'json')
+    if data_format not in ('json', 'csv'):
+        abort(400)
+    date_from, date_to = _get_date_arg('from'), _get_date_arg('to')
+    resolution = _get_resolution_arg()
+    data_version = DataVersionProcessor().get()
+    key = GraphCacheProcessor.get_key(kwargs, [('format', data_format), ('from', date_from), ('to', date_to),
+                                               ('resolution', resolution)])
+    etag = _get_etag(key, data_version)
+    if not is_resource_modified(request.environ, etag, last_modified=data_version.updated):
+        graph_requests.inc(endpoint=request.endpoint, result='not_modified')
+        return _set_validators(make_response('', 304), etag, data_version)
+    graph_requests.inc(endpoint=request.endpoint, result='miss')
     graph_builder = GraphBuilder()
-    graph = graph_builder.build(kwargs)
-    response = make_response(graph)
-    response.mimetype = 'image/png'
-    return response
+    rows = sorted(graph_builder.get_average(kwargs, date_from=date_from, date_to=date_to, resolution=resolution).items())
+    if data_format == 'csv':
+        response = Response(_get_csv_lines(rows), mimetype='text/csv')
+    else:
+        body = json.dumps([[publication_date.strftime('%Y-%m-%d'), round(value, 2)] for publication_date, value in rows],
+                          separators=(',', ':'))
+        response = Response(body, mimetype='application/json')
+    return _set_validators(response, etag, data_version)
+
+@app.route('/metrics')
+def metrics_view():
+    '''
+    Метрики процесса в текстовом формате Prometheus и итоги последнего обхода сайта.
+    '''
+    pool_stats = MongoDb.get_pool_stats()
+    mongo_pool_max_size.set(pool_stats['max_pool_size'])
+    for state in ('current', 'available'):
+        if state in pool_stats:
+            mongo_connections.set(pool_stats[state], state=state)
+    body = metrics.get_text(('dmte_graph', 'dmte_mongo'))
+    summary_path = settings.METRICS['crawl_summary_path']
+    if summary_path:
+        try:
+            with open(summary_path) as summary_file:
+                body += summary_file.read()
+        except IOError:
+            pass
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
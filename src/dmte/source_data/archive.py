@@ -0,0 +1,103 @@
+# encoding=utf8
+'''
+Архив скачанных страниц.
+@author: Mic, 2012
+'''
+
+from datetime import datetime
+from gzip import GzipFile
+from hashlib import sha1
+import os
+
+class PageArchive(object):
+    '''
+    Архив страниц на диске.
+    Содержимое хранится сжатым, по одному файлу на уникальное содержимое
+    (имя файла - хэш содержимого). Индекс - текстовый файл, в который на каждое
+    скачивание дописывается строка "время<TAB>адрес<TAB>хэш".
+    '''
+
+    # Формат времени в индексе:
+    DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, path):
+        '''
+        @param path: str - каталог архива
+        '''
+        self._path = path
+
+    @property
+    def _index_path(self):
+        '''
+        Возвращает путь к индексу.
+        @return: str
+        '''
+        return os.path.join(self._path, 'index.tsv')
+
+    def _get_object_path(self, digest):
+        '''
+        Возвращает путь к файлу с содержимым.
+        @param digest: str
+        @return: str
+        '''
+        return os.path.join(self._path, 'objects', digest[:2], '%s.gz'%digest[2:])
+
+    def _write_object(self, digest, content):
+        '''
+        Записывает содержимое, если его еще нет в архиве.
+        Файл сначала пишется во временный, чтобы при сбое не остался обрезанный.
+        @param digest: str
+        @param content: str
+        '''
+        object_path = self._get_object_path(digest)
+        if os.path.exists(object_path):
+            return
+        directory = os.path.dirname(object_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_path = '%s.%s.tmp'%(object_path, os.getpid())
+        archive_file = GzipFile(temporary_path, 'wb')
+        try:
+            archive_file.write(content)
+        finally:
+            archive_file.close()
+        os.rename(temporary_path, object_path)
+
+    def put(self, url, content, fetched=None):
+        '''
+        Сохраняет скачанную страницу и возвращает хэш ее содержимого.
+        @param url: str
+        @param content: str
+        @param fetched: datetime
+        @return: str
+        '''
+        digest = sha1(content).hexdigest()
+        self._write_object(digest, content)
+        fetched = fetched or datetime.utcnow()
+        with open(self._index_path, 'a') as index_file:
+            index_file.write('%s\t%s\t%s\n'%(fetched.strftime(self.DATETIME_FORMAT), url, digest))
+        return digest
+
+    def get(self, digest):
+        '''
+        Возвращает содержимое по хэшу.
+        @param digest: str
+        @return: str
+        '''
+        archive_file = GzipFile(self._get_object_path(digest), 'rb')
+        try:
+            return archive_file.read()
+        finally:
+            archive_file.close()
+
+    def get_entries(self):
+        '''
+        Возвращает записи индекса в порядке скачивания: время, адрес и хэш.
+        @return: generator
+        '''
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path) as index_file:
+            for line in index_file:
+                fetched, url, digest = line.rstrip('\n').split('\t')
+                yield datetime.strptime(fetched, self.DATETIME_FORMAT), url, digest
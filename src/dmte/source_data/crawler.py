@@ -0,0 +1,164 @@
+# encoding=utf8
+'''
+Параллельный обход страниц со списками объявлений.
+@author: Mic, 2012
+'''
+
+from Queue import Queue, Full, Empty
+from threading import Event, Lock, Thread
+from time import sleep, time
+from urlparse import urlparse
+
+from dmte.log import logger
+
+class HostThrottle(object):
+    '''
+    Ограничитель частоты запросов к одному хосту.
+    Интервал отсчитывается от начала предыдущего запроса, поэтому ожидание ответа
+    засчитывается в паузу.
+    '''
+
+    def __init__(self, interval):
+        '''
+        @param interval: float - минимальный интервал между запросами (секунды)
+        '''
+        self._interval = interval
+        self._lock = Lock()
+        self._next_request_times = {}
+
+    def wait(self, url):
+        '''
+        Ждет, пока к хосту можно будет сделать следующий запрос.
+        @param url: str
+        '''
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time()
+            request_time = max(now, self._next_request_times.get(host, now))
+            self._next_request_times[host] = request_time + self._interval
+        if request_time > now:
+            sleep(request_time - now)
+
+class Crawler(object):
+    '''
+    Обходчик страниц.
+    Страницы скачиваются по цепочке ссылок на следующую страницу, а разбор
+    объявлений и сохранение идут в отдельном потоке, так что скачивание следующей
+    страницы перекрывается с обработкой уже скачанной. Перекрываются только эти
+    две стадии: следующую страницу нельзя запросить, пока не найдена ссылка на нее,
+    запросы к сайту и так идут не чаще host_interval, а сохранение должно идти
+    по одной странице за раз и по порядку (объявления переезжают со страницы
+    на страницу, и сводку нельзя обновлять одновременно). Поэтому поток обработки
+    один, а настраивается только то, сколько скачанных страниц может ждать обработки.
+    '''
+
+    # Сколько ждать места в очереди перед повторной проверкой остановки (секунды):
+    QUEUE_TIMEOUT = 1
+
+    def __init__(self, parse_page, save_page, prefetch_pages, host_interval, checkpoint=None):
+        '''
+        @param parse_page: callable - url -> (adverts, next_url)
+        @param save_page: callable - (url, adverts) -> количество новых
+        @param prefetch_pages: int - сколько скачанных страниц может ждать обработки
+        @param host_interval: float - минимальный интервал между запросами к хосту (секунды)
+        @param checkpoint: callable - (url, next_url, page_count, total_count) -> None, вызывается,
+            когда страница url и все предыдущие сохранены
+        '''
+        self._parse_page = parse_page
+        self._save_page = save_page
+        self._checkpoint = checkpoint
+        self._throttle = HostThrottle(host_interval)
+        self._queue = Queue(max(prefetch_pages, 1))
+        self._stopped = Event()
+        self._errors = []
+        self.page_count = 0
+        self.total_count = 0
+
+    def _put(self, item):
+        '''
+        Кладет элемент в очередь, пока обход не остановлен.
+        @param item: mixed
+        @return: bool
+        '''
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=self.QUEUE_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _fetch(self, url, base_url):
+        '''
+        Скачивает страницы по цепочке, пока они не кончатся или обход не остановят.
+        @param url: str
+        @param base_url: str
+        '''
+        try:
+            while url is not None and not self._stopped.is_set():
+                page_url = '%s%s'%(base_url, url)
+                self._throttle.wait(page_url)
+                adverts, next_url = self._parse_page(page_url)
+                if not self._put((url, next_url, adverts)):
+                    break
+                url = next_url
+            if url is None:
+                logger.info('last page reached, stopping')
+        except Exception as e:
+            logger.exception('can not fetch page')
+            self._errors.append(e)
+            self._stopped.set()
+
+    def _process(self, new_only, base_url):
+        '''
+        Разбирает и сохраняет скачанные страницы по порядку.
+        @param new_only: bool
+        @param base_url: str
+        '''
+        while True:
+            try:
+                item = self._queue.get(timeout=self.QUEUE_TIMEOUT)
+            except Empty:
+                if self._stopped.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            if self._stopped.is_set():
+                continue
+            url, next_url, adverts = item
+            page_url = '%s%s'%(base_url, url)
+            try:
+                count = self._save_page(page_url, adverts)
+            except Exception as e:
+                logger.exception('can not process page %s', page_url)
+                self._errors.append(e)
+                self._stopped.set()
+                return
+            logger.debug('%s new adverts found on %s', count, page_url)
+            self.page_count += 1
+            self.total_count += count
+            if self._checkpoint is not None:
+                self._checkpoint(url, next_url, self.page_count, self.total_count)
+            if new_only and count == 0:
+                logger.info('no new adverts found on page, stopping')
+                self._stopped.set()
+
+    def crawl(self, url, base_url, new_only=False):
+        '''
+        Обходит все страницы, начиная с указанной.
+        Возвращает количество новых объявлений.
+        @param url: str
+        @param base_url: str
+        @param new_only: bool
+        @return: int
+        '''
+        worker = Thread(target=self._process, args=(new_only, base_url))
+        worker.daemon = True
+        worker.start()
+        self._fetch(url, base_url)
+        self._put(None)
+        worker.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.total_count
@@ -1,13 +1,240 @@
 # encoding=utf8
+'''
+Загрузка страниц.
+@author: Mic, 2012
+'''
 
-from urllib import urlopen
+from httplib import BadStatusLine, HTTPConnection, HTTPSConnection, HTTPException
+from socket import error as SocketError, timeout as SocketTimeout
+from time import time
+from urlparse import urljoin, urlsplit
+from zlib import decompress, MAX_WBITS
+import errno
+import shelve
+
+from dmte.conf import settings
+
+# Кодировка страниц сайта:
+PAGE_ENCODING = 'cp1251'
+
+class PageResponse(object):
+    '''
+    Ответ на запрос страницы.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.content = None
+        self.not_modified = False
+        # Время запроса (секунды):
+        self.elapsed = None
+        # Сколько байт пришло по сети и сколько получилось после распаковки:
+        self.received_bytes = 0
+        self.content_bytes = 0
+
+    def __str__(self):
+        return 'PageResponse(%s, %s)'%(self.url, self.status)
+
+class Session(object):
+    '''
+    Сессия для скачивания страниц.
+    Держит открытыми соединения с хостами, просит сжатые ответы, отправляет
+    If-None-Match/If-Modified-Since для уже скачанных страниц и переходит по редиректам.
+    Не потокобезопасна.
+    '''
+
+    # Статусы редиректов и сколько переходов подряд допускается:
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    # Ошибки сокета, с которыми сервер закрывает простаивающее соединение:
+    CLOSED_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+    def __init__(self, validators=None, timeout=None):
+        '''
+        @param validators: dict - хранилище ETag, Last-Modified и содержимого по адресу
+        @param timeout: float
+        '''
+        self._connections = {}
+        self._validators = {} if validators is None else validators
+        self._timeout = timeout
+        self.request_count = 0
+        self.not_modified_count = 0
+        self.received_bytes = 0
+        self.content_bytes = 0
+        self.elapsed = 0
+
+    def _get_connection(self, scheme, host):
+        '''
+        Возвращает открытое соединение с хостом.
+        @param scheme: str
+        @param host: str
+        @return: HTTPConnection
+        '''
+        key = (scheme, host)
+        if key not in self._connections:
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            self._connections[key] = connection_class(host, timeout=self._timeout)
+        return self._connections[key]
+
+    def _close_connection(self, scheme, host):
+        '''
+        Закрывает соединение с хостом.
+        @param scheme: str
+        @param host: str
+        '''
+        connection = self._connections.pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
+
+    def _get_headers(self, url):
+        '''
+        Возвращает заголовки запроса.
+        @param url: str
+        @return: dict
+        '''
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        stored = self._validators.get(url)
+        if stored is not None:
+            etag, last_modified, _ = stored
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def _is_closed_connection_error(self, error):
+        '''
+        Проверяет, что ошибка означает закрытое сервером соединение (а не медленный
+        или недоступный сервер): только такой запрос имеет смысл повторить сразу.
+        @param error: Exception
+        @return: bool
+        '''
+        if isinstance(error, SocketTimeout):
+            return False
+        if isinstance(error, BadStatusLine):
+            return True
+        return isinstance(error, SocketError) and error.errno in self.CLOSED_CONNECTION_ERRNOS
+
+    def _request(self, scheme, host, path, headers):
+        '''
+        Выполняет запрос и возвращает ответ и его тело.
+        Если сервер закрыл соединение, оставшееся от прошлых запросов, повторяет
+        запрос один раз в новом. Таймауты и ошибки нового соединения не повторяются.
+        @param scheme: str
+        @param host: str
+        @param path: str
+        @param headers: dict
+        @return: HTTPResponse, str
+        '''
+        while True:
+            reused = (scheme, host) in self._connections
+            connection = self._get_connection(scheme, host)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, SocketError) as e:
+                self._close_connection(scheme, host)
+                if reused and self._is_closed_connection_error(e):
+                    continue
+                raise
+            if response.will_close:
+                self._close_connection(scheme, host)
+            return response, body
+
+    def _request_url(self, url):
+        '''
+        Запрашивает страницу, переходя по редиректам.
+        Возвращает адрес, с которого пришел ответ, сам ответ, его тело и количество
+        байт, полученных по сети за все переходы.
+        @param url: str
+        @return: str, HTTPResponse, str, int
+        '''
+        received_bytes = 0
+        for _ in range(self.MAX_REDIRECTS + 1):
+            scheme, host, path, query, _ = urlsplit(url)
+            if query:
+                path = '%s?%s'%(path, query)
+            response, body = self._request(scheme, host, path or '/', self._get_headers(url))
+            received_bytes += len(body)
+            location = response.getheader('location')
+            if response.status not in self.REDIRECT_STATUSES or not location:
+                return url, response, body, received_bytes
+            url = urljoin(url, location)
+        raise HTTPException('too many redirects for %s'%url)
+
+    def get(self, url):
+        '''
+        Скачивает страницу.
+        @param url: str
+        @return: PageResponse
+        '''
+        page_response = PageResponse(url)
+        started = time()
+        final_url, response, body, page_response.received_bytes = self._request_url(url)
+        page_response.elapsed = time() - started
+        page_response.status = response.status
+        if response.status == 304:
+            page_response.not_modified = True
+            page_response.content = self._validators[final_url][2]
+        elif response.status == 200:
+            if response.getheader('content-encoding') == 'gzip':
+                body = decompress(body, 16 + MAX_WBITS)
+            page_response.content = body
+            etag, last_modified = response.getheader('etag'), response.getheader('last-modified')
+            if etag is not None or last_modified is not None:
+                self._validators[final_url] = (etag, last_modified, body)
+        else:
+            raise HTTPException('unexpected status %s for %s'%(response.status, url))
+        page_response.content_bytes = len(page_response.content)
+        self.request_count += 1
+        self.not_modified_count += int(page_response.not_modified)
+        self.received_bytes += page_response.received_bytes
+        self.content_bytes += page_response.content_bytes
+        self.elapsed += page_response.elapsed
+        return page_response
+
+    def close(self):
+        '''
+        Закрывает соединения и хранилище валидаторов.
+        '''
+        for scheme, host in self._connections.keys():
+            self._close_connection(scheme, host)
+        if hasattr(self._validators, 'close'):
+            self._validators.close()
+
+# Сессия по умолчанию:
+_session = None
+
+def get_session():
+    '''
+    Возвращает сессию по умолчанию.
+    Если указан путь к хранилищу валидаторов, они сохраняются между запусками.
+    @return: Session
+    '''
+    global _session
+    if _session is None:
+        validators_path = settings.SOURCE_DATA['validators_path']
+        validators = shelve.open(validators_path) if validators_path else None
+        _session = Session(validators, settings.SOURCE_DATA['timeout'])
+    return _session
+
+def close_session():
+    '''
+    Закрывает сессию по умолчанию, если она открыта.
+    Следующий вызов get_session откроет новую: с пустыми счетчиками и заново открытыми валидаторами.
+    '''
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
 
 def get_page_content(url):
     '''
-    Скачивает и возвращает содержимое страницы.
+    Скачивает и возвращает содержимое страницы (в кодировке PAGE_ENCODING).
     @param url: str
     @return: str
     '''
-    response = urlopen(url)
-    response_body = response.read()
-    return response_body.decode('cp1251')
+    return get_session().get(url).content
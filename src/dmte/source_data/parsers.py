@@ -5,7 +5,7 @@
 '''
 
 from datetime import datetime
-from re import search, UNICODE
+import re
 
 from lxml import etree
 
@@ -20,188 +20,119 @@ class ParserException(Exception):
 class AdvertParser(object):
     '''
     Парсер объявлений.
+    Узлы ищутся один раз на объявление, а все поля описания достаются
+    одним проходом по его тексту.
     '''
-    
-    def _get_external_id(self, advert_node):
+
+    # Ссылка на объявление: внешний идентификатор и количество комнат:
+    LINK_XPATH = etree.XPath('.//a[@class="visited_ads"]')
+    # Описание: тип, район, этажи и площадь:
+    DESCRIPTION_XPATH = etree.XPath('.//p[2]')
+    ADDRESS_XPATH = etree.XPath('.//p[2]/a[@class="map_link"]')
+    PRICE_XPATH = etree.XPath('.//p[@style="margin: 10px 0 0 2px;"]/b')
+    PUBLICATION_DATE_XPATH = etree.XPath('.//p[@class="absmiddle"]')
+
+    EXTERNAL_ID_PATTERN = re.compile('id=(\d+)')
+    ROOM_COUNT_PATTERN = re.compile(u'(\d+)-комнатную', re.UNICODE)
+    PUBLICATION_DATE_PATTERN = re.compile(u'(\d{1,2}) (\w+) (\d{4})', re.UNICODE)
+    DESCRIPTION_PATTERN = re.compile(u'|'.join((
+        u'\((?P<type>\w+)\)',
+        u'в (?P<district>\w+) районе',
+        u'на (?P<floor_number>\d+)-м этаже',
+        u'в (?P<floor_count>\d+)-этажном',
+        u'общей площадью (?P<area>\d+(?:\.\d+)*)',
+    )), re.UNICODE)
+
+    # Поля описания, которые ищутся только в тексте до первого вложенного узла:
+    DESCRIPTION_HEAD_FIELDS = ('type', 'district', 'floor_number', 'floor_count')
+
+    # Названия месяцев в родительном падеже:
+    MONTHS = (u'января', u'февраля', u'марта', u'апреля', u'мая', u'июня', u'июля',
+              u'августа', u'сентября', u'октября', u'ноября', u'декабря')
+
+    # Нормализованные названия районов:
+    DISTRICTS = {
+        u'Кировском': u'кировский',
+        u'Ленинском': u'ленинский',
+        u'Октябрьском': u'октябрьский',
+        u'Советском': u'советский',
+        u'Томском': u'томский',
+    }
+
+    def __init__(self, now=None):
         '''
-        Возвращает внешний идентификатор объявления.
-        @param advert_node: Element
-        @return: int
+        @param now: datetime - время скачивания страницы (по умолчанию - текущее)
         '''
-        xpath = etree.XPath('.//a[@class="visited_ads"]')
-        node = xpath(advert_node)[0]
-        found = search('id=(\d+)', node.attrib['href'])
-        if found is None:
-            raise ParserException('no external id found')
-        return found.group(1)
-    
-    def _get_type(self, advert_node):
+        self._now = now
+
+    def _get_node(self, xpath, advert_node, name):
         '''
-        Возвращает тип (первичное, вторичное).
+        Возвращает первый найденный узел.
+        @param xpath: XPath
         @param advert_node: Element
-        @return: str
+        @param name: str
+        @return: Element
         '''
-        xpath = etree.XPath('.//p[2]')
-        node = xpath(advert_node)[0]
-        found = search(u'\((\w+)\)', node.text, UNICODE)
-        if found is None:
-            raise ParserException('no type found')
-        return found.group(1)
-    
+        nodes = xpath(advert_node)
+        if not nodes:
+            raise ParserException('no %s found'%name)
+        return nodes[0]
+
+    def _get_description_fields(self, node):
+        '''
+        Возвращает найденные в описании значения полей.
+        Тип, район и этажи ищутся в тексте до первого вложенного узла,
+        площадь - во всем тексте описания.
+        @param node: Element
+        @return: dict
+        '''
+        head = node.text or u''
+        text = u''.join(node.itertext()) + (node.tail or u'')
+        fields = {}
+        for found in self.DESCRIPTION_PATTERN.finditer(text):
+            name = found.lastgroup
+            if name in fields:
+                continue
+            if name in self.DESCRIPTION_HEAD_FIELDS and found.end() > len(head):
+                continue
+            fields[name] = found.group(name)
+        return fields
+
     def _get_normalized_district(self, district):
         '''
         Возвращает нормализованное название района.
         @param district: str
         @return: str
         '''
-        if district == u'Кировском':
-            return u'кировский'
-        if district == u'Ленинском':
-            return u'ленинский'
-        if district == u'Октябрьском':
-            return u'октябрьский'
-        if district == u'Советском':
-            return u'советский'
-        if district == u'Томском':
-            return u'томский'
-        raise ParserException(u'can not normalize district "%s"'%district.encode('utf8'))
-    
-    def _get_district(self, advert_node):
-        '''
-        Возвращает район.
-        @param advert_node: Element
-        @return: str
-        '''
-        xpath = etree.XPath('.//p[2]')
-        node = xpath(advert_node)[0]
-        found = search(u'в (\w+) районе', node.text, UNICODE)
-        if found is None:
-            raise ParserException('no district found')
-        return self._get_normalized_district(found.group(1))
-    
-    def _get_address(self, advert_node):
-        '''
-        Возвращает адрес.
-        @param advert_node: Element
-        @return: str
-        '''
-        xpath = etree.XPath('.//p[2]/a[@class="map_link"]')
-        nodes = xpath(advert_node)
-        if not nodes:
-            raise ParserException('no address found')
-        return nodes[0].text
-    
-    def _get_floor_number(self, advert_node):
-        '''
-        Возвращает номер этажа.
-        @param advert_node: Element
-        @return: int
-        '''
-        xpath = etree.XPath('.//p[2]')
-        node = xpath(advert_node)[0]
-        found = search(u'на (\d+)-м этаже', node.text, UNICODE)
-        if found is None:
-            raise ParserException('no floor found')
-        return int(found.group(1))
-    
-    def _get_floor_count(self, advert_node):
-        '''
-        Возвращает количество этажей.
-        @param advert_node: Element
-        @return: int
-        '''
-        xpath = etree.XPath('.//p[2]')
-        node = xpath(advert_node)[0]
-        found = search(u'в (\d+)-этажном', node.text, UNICODE)
-        if found is None:
-            raise ('no floor found')
-        return int(found.group(1))
+        if district not in self.DISTRICTS:
+            raise ParserException('can not normalize district "%s"'%district.encode('utf8'))
+        return self.DISTRICTS[district]
 
-    def _get_area(self, advert_node):
-        '''
-        Возвращает площадь.
-        @param advert_node: Element
-        @return: float
-        '''
-        xpath = etree.XPath('.//p[2]')
-        node = xpath(advert_node)[0]
-        node_text = etree.tostring(node, encoding='utf8', method='text').decode('utf8')
-        found = search(u'общей площадью (\d+(\.\d+)*)', node_text, UNICODE)
-        if found is None:
-            raise ParserException('no area found')
-        return float(found.group(1))
-    
-    def _get_room_count(self, advert_node):
-        '''
-        Возвращает количество комнат.
-        @param advert_node: Element
-        @return: int
-        '''
-        xpath = etree.XPath('.//a[@class="visited_ads"]')
-        node = xpath(advert_node)[0]
-        found = search(u'(\d+)-комнатную', node.text, UNICODE)
-        if found is None:
-            raise ParserException('no room count found')
-        return int(found.group(1))
-    
-    def _get_price(self, advert_node):
-        '''
-        Возвращает цену.
-        @param advert_node: Element
-        @return: float
-        '''
-        xpath = etree.XPath('.//p[@style="margin: 10px 0 0 2px;"]/b')
-        node = xpath(advert_node)[0]
-        return float(node.text) * 1000
-    
     def _get_month_number(self, month):
         '''
         Возвращает номер месяца.
         @param month: str
         @return: int
         '''
-        if month == u'января':
-            return 1
-        if month == u'февраля':
-            return 2
-        if month == u'марта':
-            return 3
-        if month == u'апреля':
-            return 4
-        if month == u'мая':
-            return 5
-        if month == u'июня':
-            return 6
-        if month == u'июля':
-            return 7
-        if month == u'августа':
-            return 8
-        if month == u'сентября':
-            return 9
-        if month == u'октября':
-            return 10
-        if month == u'ноября':
-            return 11
-        if month == u'декабря':
-            return 12
-        raise ParserException('can not define number for month "%s"'%month.encode('utf8'))
-    
-    def _get_publication_datetime(self, advert_node):
+        if month not in self.MONTHS:
+            raise ParserException('can not define number for month "%s"'%month.encode('utf8'))
+        return self.MONTHS.index(month) + 1
+
+    def _get_publication_datetime(self, node):
         '''
         Возвращает дату публикации объявления.
-        @param advert_node: Element
+        @param node: Element
         @return: datetime
         '''
-        xpath = etree.XPath('.//p[@class="absmiddle"]')
-        node = xpath(advert_node)[0]
-        if u'Опубликовано сегодня' in node.text:
-            return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        found = search(u'(\d{1,2}) (\w+) (\d{4})', node.text, UNICODE)
+        text = node.text or u''
+        if u'Опубликовано сегодня' in text:
+            return (self._now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+        found = self.PUBLICATION_DATE_PATTERN.search(text)
         if found is None:
             raise ParserException('no publication date found')
         day, month, year = int(found.group(1)), self._get_month_number(found.group(2)), int(found.group(3))
         return datetime(year, month, day)
-    
+
     def parse(self, advert_node):
         '''
         Возвращает заполненное объявление.
@@ -209,31 +140,47 @@ class AdvertParser(object):
         @return: Advert
         '''
         advert = Advert()
-        advert.external_id = self._get_external_id(advert_node)
-        advert.type = self._get_type(advert_node)
-        advert.district = self._get_district(advert_node)
-        advert.address = self._get_address(advert_node)
-        advert.floor_number = self._get_floor_number(advert_node)
-        advert.floor_count = self._get_floor_count(advert_node)
-        advert.area = self._get_area(advert_node)
-        advert.room_count = self._get_room_count(advert_node)
-        advert.price = self._get_price(advert_node)
-        advert.publication_date = self._get_publication_datetime(advert_node)
+        link_node = self._get_node(self.LINK_XPATH, advert_node, 'link')
+        found = self.EXTERNAL_ID_PATTERN.search(link_node.attrib.get('href', ''))
+        if found is None:
+            raise ParserException('no external id found')
+        advert.external_id = found.group(1)
+        description_node = self._get_node(self.DESCRIPTION_XPATH, advert_node, 'description')
+        fields = self._get_description_fields(description_node)
+        for name in ('type', 'district', 'floor_number', 'floor_count', 'area'):
+            if name not in fields:
+                raise ParserException('no %s found'%name.replace('_', ' '))
+        advert.type = fields['type']
+        advert.district = self._get_normalized_district(fields['district'])
+        advert.address = self._get_node(self.ADDRESS_XPATH, advert_node, 'address').text
+        advert.floor_number = int(fields['floor_number'])
+        advert.floor_count = int(fields['floor_count'])
+        advert.area = float(fields['area'])
+        found = self.ROOM_COUNT_PATTERN.search(link_node.text or u'')
+        if found is None:
+            raise ParserException('no room count found')
+        advert.room_count = int(found.group(1))
+        advert.price = float(self._get_node(self.PRICE_XPATH, advert_node, 'price').text) * 1000
+        publication_date_node = self._get_node(self.PUBLICATION_DATE_XPATH, advert_node, 'publication date')
+        advert.publication_date = self._get_publication_datetime(publication_date_node)
         return advert
     
 class AdvertListParser(object):
     '''
     Парсер списка объявлений.
     '''
+
+    NEXT_PAGE_XPATH = etree.XPath('.//span[@class="pager_next"]/a')
     
-    def parse_adverts(self, root_node):
+    def parse_adverts(self, root_node, now=None):
         '''
         Разбирает и возвращает список объявлений.
         @param root_node: Element
+        @param now: datetime - время скачивания страницы (по умолчанию - текущее)
         @return: list
         '''
+        parser = AdvertParser(now)
         for advert_node in root_node.findall('.//table[@class="realty"]//tr[@class]'):
-            parser = AdvertParser()
             try:
                 yield parser.parse(advert_node)
             except ParserException as e:
@@ -245,8 +192,7 @@ class AdvertListParser(object):
         @param root_node: Element
         @return: str
         '''
-        xpath = etree.XPath('.//span[@class="pager_next"]/a')
-        nodes = xpath(root_node)
+        nodes = self.NEXT_PAGE_XPATH(root_node)
         if not nodes:
             return None
         return nodes[0].attrib['href']
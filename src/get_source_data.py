@@ -4,82 +4,271 @@
 @author: Mic, 2012
 '''
 
-from time import sleep
+from datetime import datetime
+from time import sleep, time
+from uuid import uuid4
 import sys
 
 from lxml import etree
 
-from dmte.source_data.loaders import get_page_content
-from dmte.log import logger
+from dmte.conf import settings
+from dmte.source_data.archive import PageArchive
+from dmte.source_data.crawler import Crawler
+from dmte.source_data.loaders import close_session, get_session, PAGE_ENCODING
+from dmte.log import logger, setup_logging
+from dmte.metrics import (crawl_adverts, crawl_last_run_finished, crawl_last_run_new_adverts, crawl_last_run_pages,
+                          crawl_last_run_seconds, crawl_pages, crawl_received_bytes, crawl_stage_seconds, metrics)
 from dmte.source_data.parsers import AdvertListParser
-from dmte.processors import AdvertProcessor
-
-def save_advert(advert):
-    '''
-    Сохраняет объявление в БД.
-    Возвращает, новое ли объявление.
-    @param advert: Advert
-    @return: bool
-    '''
-    processor = AdvertProcessor()
-    stored = processor.get_by_external_id(advert.external_id)
-    if stored is not None:
-        logger.debug('advert with external id %s found', advert.external_id)
-        advert.id = stored.id
-    processor.save(advert)
-    logger.debug('advert with external id %s saved', advert.external_id)
-    return stored is None
+from dmte.models import CrawlCheckpoint
+from dmte.profiling import profiled
+from dmte.processors import AdvertProcessor, AdvertRollupProcessor, CrawlCheckpointProcessor, DataVersionProcessor
 
 def save_adverts(adverts):
     '''
-    Сохраняет объявления.
+    Сохраняет новые и изменившиеся объявления одним пакетом и обновляет сводку.
+    Объявления, которые не изменились с прошлого раза, не записываются.
     Возвращает количество новых.
     @param adverts: list
     @return: int
     '''
-    count = 0
-    for advert in adverts:
-        if save_advert(advert):
-            count += 1
+    adverts = list(adverts)
+    with crawl_stage_seconds.time(stage='save'):
+        processor = AdvertProcessor()
+        stored = processor.get_by_external_ids(advert.external_id for advert in adverts)
+        changed = processor.get_changed(adverts, stored)
+        count = processor.save_many(changed, stored)
+        logger.debug('%s new adverts saved, %s changed, %s unchanged skipped', count, len(changed) - count,
+                     len(adverts) - len(changed))
+        changed_stored = dict((advert.external_id, stored[advert.external_id]) for advert in changed
+                              if advert.external_id in stored)
+        rollup_processor = AdvertRollupProcessor()
+        rollup_count = rollup_processor.update(changed_stored.values(), changed)
+        logger.debug('%s rollup groups updated', rollup_count)
+    crawl_adverts.inc(count, result='new')
+    crawl_adverts.inc(len(changed) - count, result='changed')
+    crawl_adverts.inc(len(adverts) - len(changed), result='unchanged')
     return count
 
 def parse_page(url):
     '''
-    Разбирает страницу на объявления.
-    Возвращает список найденных объявлений и адрес следующей страницы.
+    Скачивает страницу и готовит ее к разбору на объявления.
+    Возвращает объявления (они разбираются по мере перебора) и адрес следующей страницы.
     @param url: str
     @return: list, str
     '''
     logger.debug('parsing adverts on %s', url)
-    content = get_page_content(url)
-    root_node = etree.fromstring(content, parser=etree.HTMLParser())
+    with crawl_stage_seconds.time(stage='fetch'):
+        response = get_session().get(url)
+    crawl_pages.inc()
+    crawl_received_bytes.inc(response.received_bytes)
+    logger.debug('%s: status %s, %s bytes received, %s bytes of content, %.3fs', url, response.status,
+                 response.received_bytes, response.content_bytes, response.elapsed)
+    if settings.SOURCE_DATA['archive_path']:
+        PageArchive(settings.SOURCE_DATA['archive_path']).put(url, response.content)
+    return parse_content(response.content)
+
+def parse_content(content, fetched=None):
+    '''
+    Разбирает содержимое страницы на объявления.
+    Возвращает список найденных объявлений и адрес следующей страницы.
+    @param content: str
+    @param fetched: datetime - время скачивания страницы
+    @return: list, str
+    '''
+    with crawl_stage_seconds.time(stage='decode'):
+        root_node = etree.fromstring(content, parser=etree.HTMLParser(encoding=PAGE_ENCODING))
     parser = AdvertListParser()
-    return parser.parse_adverts(root_node), parser.parse_next_page_address(root_node)
+    adverts = crawl_stage_seconds.time_iterator(parser.parse_adverts(root_node, fetched), stage='parse')
+    return adverts, parser.parse_next_page_address(root_node)
 
-def parse_all(new_only=False):
+@profiled('page', lambda url: url)
+def process_page(url):
     '''
-    Разбирает все страницы.
+    Скачивает, разбирает и сохраняет страницу.
+    Возвращает количество новых объявлений и адрес следующей страницы.
+    @param url: str
+    @return: int, str
+    '''
+    adverts, next_url = parse_page(url)
+    return save_adverts(adverts), next_url
+
+@profiled('page', lambda url, adverts: url)
+def save_page(url, adverts):
+    '''
+    Разбирает и сохраняет уже скачанную страницу (при обходе в режиме concurrent
+    скачивание идет в другом потоке и в профиль не попадает).
+    Возвращает количество новых объявлений.
+    @param url: str
+    @param adverts: iterable
+    @return: int
+    '''
+    return save_adverts(adverts)
+
+def parse_sequentially(url, new_only, save_checkpoint):
+    '''
+    Разбирает страницы по одной, начиная с указанной.
+    Возвращает количество новых объявлений.
+    @param url: str
     @param new_only: bool
+    @param save_checkpoint: callable - (url, next_url, page_count, total_count) -> None
+    @return: int
     '''
-    if new_only:
-        logger.info('parsing new adverts only')
-    else:
-        logger.info('parsing all adverts')
-    next_url = '/realty/?type=1&otype=1&listview=1&perpage=200'
-    total_count = 0
-    while True:
-        adverts, next_url = parse_page('http://www.tomsk.ru09.ru%s'%next_url)
-        count = save_adverts(adverts)
+    page_count, total_count = 0, 0
+    while url is not None:
+        count, next_url = process_page('%s%s'%(settings.SOURCE_DATA['base_url'], url))
         logger.debug('%s new adverts found on page', count)
+        page_count += 1
         total_count += count
+        save_checkpoint(url, next_url, page_count, total_count)
         if new_only and count == 0:
             logger.info('no new adverts found on page, stopping')
             break
-        if next_url is None:
+        url = next_url
+        if url is None:
             logger.info('last page reached, stopping')
             break
-        sleep(1)
-    logger.info('%s new adverts found', total_count)
+        sleep(settings.SOURCE_DATA['host_interval'])
+    return total_count
+
+def parse_concurrently(url, new_only, save_checkpoint):
+    '''
+    Разбирает страницы, начиная с указанной, скачивая следующую во время разбора предыдущей.
+    Возвращает количество новых объявлений.
+    @param url: str
+    @param new_only: bool
+    @param save_checkpoint: callable - (url, next_url, page_count, total_count) -> None
+    @return: int
+    '''
+    crawler = Crawler(parse_page, save_page, settings.SOURCE_DATA['prefetch_pages'],
+                      settings.SOURCE_DATA['host_interval'], save_checkpoint)
+    return crawler.crawl(url, settings.SOURCE_DATA['base_url'], new_only)
+
+def get_checkpoint(new_only, resume):
+    '''
+    Возвращает состояние обхода: при resume - незавершенное состояние прошлого
+    запуска в том же режиме (если оно есть), иначе - новое, с первой страницы.
+    @param new_only: bool
+    @param resume: bool
+    @return: CrawlCheckpoint
+    '''
+    processor = CrawlCheckpointProcessor()
+    if resume:
+        checkpoint = processor.get(new_only)
+        if checkpoint is not None and not checkpoint.finished:
+            logger.info('resuming run %s after %s: %s pages done, %s new adverts found', checkpoint.run_id,
+                        checkpoint.last_url, checkpoint.page_count, checkpoint.total_count)
+            return checkpoint
+        logger.info('no unfinished run found, starting from the first page')
+    checkpoint = CrawlCheckpoint()
+    checkpoint.run_id = uuid4().hex
+    checkpoint.new_only = new_only
+    checkpoint.next_url = settings.SOURCE_DATA['start_url']
+    checkpoint.started = datetime.utcnow()
+    processor.save(checkpoint)
+    return checkpoint
+
+def get_checkpoint_saver(checkpoint):
+    '''
+    Возвращает функцию, сохраняющую прогресс обхода.
+    Счетчики, переданные ей, прибавляются к счетчикам на момент начала (или продолжения) обхода.
+    @param checkpoint: CrawlCheckpoint
+    @return: callable
+    '''
+    processor = CrawlCheckpointProcessor()
+    page_count, total_count = checkpoint.page_count, checkpoint.total_count
+    def save_checkpoint(url, next_url, pages, count):
+        checkpoint.last_url = url
+        checkpoint.next_url = next_url
+        checkpoint.page_count = page_count + pages
+        checkpoint.total_count = total_count + count
+        processor.save(checkpoint)
+    return save_checkpoint
+
+def prepare_db():
+    '''
+    Создает индексы и строит сводку, если она пуста, а объявления уже есть:
+    иначе сводка будет содержать только объявления, сохраненные после ее появления.
+    '''
+    AdvertProcessor().ensure_indexes()
+    processor = AdvertRollupProcessor()
+    processor.ensure_indexes()
+    count = processor.ensure_built()
+    if count is not None:
+        logger.info('rollup was empty and has been rebuilt, %s groups', count)
+
+def reparse_archive():
+    '''
+    Заново разбирает и сохраняет все страницы из архива в порядке скачивания.
+    Одинаковое содержимое разбирается один раз.
+    '''
+    if not settings.SOURCE_DATA['archive_path']:
+        logger.error('archive path is not set, nothing to reparse')
+        return
+    archive = PageArchive(settings.SOURCE_DATA['archive_path'])
+    prepare_db()
+    parsed = set()
+    page_count, total_count = 0, 0
+    for fetched, url, digest in archive.get_entries():
+        if digest in parsed:
+            continue
+        parsed.add(digest)
+        logger.debug('reparsing %s fetched at %s', url, fetched)
+        adverts, _ = parse_content(archive.get(digest), fetched)
+        total_count += save_adverts(adverts)
+        page_count += 1
+    DataVersionProcessor().bump()
+    logger.info('%s archived pages reparsed, %s new adverts found', page_count, total_count)
+
+def write_crawl_summary(checkpoint, seconds):
+    '''
+    Записывает метрики обхода и его итоги в файл, который отдает /metrics.
+    @param checkpoint: CrawlCheckpoint
+    @param seconds: float - длительность запуска
+    '''
+    summary_path = settings.METRICS['crawl_summary_path']
+    if not summary_path:
+        return
+    crawl_last_run_pages.set(checkpoint.page_count)
+    crawl_last_run_new_adverts.set(checkpoint.total_count)
+    crawl_last_run_seconds.set(seconds)
+    crawl_last_run_finished.set(time())
+    metrics.write(summary_path, 'dmte_crawl')
+
+def parse_all(new_only=False, concurrent=False, resume=False):
+    '''
+    Разбирает все страницы.
+    Прогресс сохраняется после каждой страницы отдельно для каждого режима, и прерванный
+    обход можно продолжить (resume) - в том же режиме, даже если между ними прошли обходы в другом.
+    @param new_only: bool
+    @param concurrent: bool
+    @param resume: bool
+    '''
+    started = time()
+    checkpoint = get_checkpoint(new_only, resume)
+    if checkpoint.new_only:
+        logger.info('parsing new adverts only')
+    else:
+        logger.info('parsing all adverts')
+    prepare_db()
+    save_checkpoint = get_checkpoint_saver(checkpoint)
+    if concurrent:
+        parse_concurrently(checkpoint.next_url, checkpoint.new_only, save_checkpoint)
+    else:
+        parse_sequentially(checkpoint.next_url, checkpoint.new_only, save_checkpoint)
+    checkpoint.finished = True
+    CrawlCheckpointProcessor().save(checkpoint)
+    DataVersionProcessor().bump()
+    session = get_session()
+    logger.info('%s pages loaded (%s not modified), %s bytes received, %s bytes of content, %.3fs', session.request_count,
+                session.not_modified_count, session.received_bytes, session.content_bytes, session.elapsed)
+    close_session()
+    logger.info('%s pages parsed, %s new adverts found', checkpoint.page_count, checkpoint.total_count)
+    write_crawl_summary(checkpoint, time() - started)
 
-new_only = len(sys.argv) > 1 and sys.argv[1] == 'new'
-parse_all(new_only)
+if __name__ == '__main__':
+    setup_logging()
+    modes = set(sys.argv[1:])
+    if 'reparse' in modes:
+        reparse_archive()
+    else:
+        parse_all('new' in modes, 'concurrent' in modes, 'resume' in modes)
@@ -0,0 +1,60 @@
+# encoding=utf8
+'''
+Обслуживание БД.
+@author: Mic, 2012
+'''
+
+import sys
+
+from dmte.log import logger, setup_logging
+from dmte.processors import AdvertProcessor, AdvertRollupProcessor, DataVersionProcessor
+
+def rebuild_rollup():
+    '''
+    Заново строит сводку по объявлениям.
+    '''
+    processor = AdvertRollupProcessor()
+    count = processor.rebuild()
+    DataVersionProcessor().bump()
+    logger.info('rollup rebuilt, %s groups', count)
+
+def ensure_indexes():
+    '''
+    Создает индексы для всех коллекций и строит сводку, если она пуста.
+    '''
+    for processor in (AdvertProcessor(), AdvertRollupProcessor()):
+        processor.ensure_indexes()
+    logger.info('indexes ensured')
+    count = AdvertRollupProcessor().ensure_built()
+    if count is not None:
+        DataVersionProcessor().bump()
+        logger.info('rollup was empty and has been rebuilt, %s groups', count)
+
+def explain():
+    '''
+    Печатает планы всех запросов и отмечает плохие: полные просмотры коллекций,
+    запросы не по тем индексам и просмотр лишних ключей.
+    '''
+    failures = 0
+    for processor in (AdvertProcessor(), AdvertRollupProcessor()):
+        for name, stages, problem in processor.explain():
+            if problem is None:
+                logger.info('ok   %s: %s', name, ' > '.join(stages))
+            else:
+                failures += 1
+                logger.warning('FAIL %s: %s (%s)', name, ' > '.join(stages), problem)
+    if failures:
+        logger.warning('%s queries have bad plans', failures)
+        sys.exit(1)
+
+COMMANDS = {
+    'ensure_indexes': ensure_indexes,
+    'explain': explain,
+    'rebuild_rollup': rebuild_rollup,
+}
+
+setup_logging()
+if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+    logger.error('usage: %s %s', sys.argv[0], '|'.join(sorted(COMMANDS)))
+    sys.exit(1)
+COMMANDS[sys.argv[1]]()
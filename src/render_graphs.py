@@ -0,0 +1,96 @@
+# encoding=utf8
+'''
+Построение всех возможных графиков заранее, после получения новых данных.
+@author: Mic, 2012
+'''
+
+from itertools import product
+from multiprocessing import Pool, cpu_count
+from time import time
+from traceback import format_exc
+
+from dmte.graphics import GraphBuilder
+from dmte.log import logger, setup_logging
+from dmte.processors import AdvertProcessor, DataVersionProcessor, GraphCacheProcessor
+
+# Значения параметров, означающие "любой":
+WILDCARDS = {
+    'type': 'all',
+    'district': 'all',
+    'floor_number': 0,
+    'room_count': 0,
+}
+
+def get_all_params():
+    '''
+    Возвращает параметры всех графиков, которые может запросить посетитель,
+    в том виде, в каком их передает построителю страница графика.
+    @return: list
+    '''
+    aggregated = AdvertProcessor().get_aggregated()
+    fields = sorted(WILDCARDS)
+    values = [[WILDCARDS[field]] + list(aggregated[field]) for field in fields]
+    all_params = []
+    for combination in product(*values):
+        params = dict((field, value) for field, value in zip(fields, combination) if value != WILDCARDS[field])
+        all_params.append(params)
+    return all_params
+
+def render(params, version):
+    '''
+    Строит график и сохраняет его в кэш.
+    Возвращает ключ графика, время построения и ошибку (None, если график построен):
+    ошибка одного графика не должна останавливать построение остальных.
+    @param params: dict
+    @param version: int
+    @return: str, float, str
+    '''
+    key = GraphCacheProcessor.get_key(params)
+    started = time()
+    try:
+        graph = GraphBuilder().build(params)
+        GraphCacheProcessor().save(key, version, graph)
+    except Exception:
+        return key, time() - started, format_exc().rstrip()
+    return key, time() - started, None
+
+def render_star(args):
+    '''
+    Распаковывает аргументы для render (Pool.imap передает один аргумент).
+    @param args: tuple
+    @return: str, float, str
+    '''
+    return render(*args)
+
+def render_all():
+    '''
+    Строит все графики в нескольких процессах.
+    '''
+    version = DataVersionProcessor().get().version
+    all_params = get_all_params()
+    logger.info('rendering %s graphs for data version %s on %s processes', len(all_params), version, cpu_count())
+    started = time()
+    pool = Pool(cpu_count())
+    try:
+        timings = []
+        failures = 0
+        for key, seconds, error in pool.imap_unordered(render_star, [(params, version) for params in all_params]):
+            if error is not None:
+                logger.error('%.3fs %s failed:\n%s', seconds, key, error)
+                failures += 1
+                continue
+            logger.info('%.3fs %s', seconds, key)
+            timings.append(seconds)
+    finally:
+        pool.close()
+        pool.join()
+    total = time() - started
+    if timings:
+        logger.info('%s graphs rendered in %.3fs (%.1f graphs/s), per graph: mean %.3fs, max %.3fs',
+                    len(timings), total, len(timings) / total, sum(timings) / len(timings), max(timings))
+    if failures:
+        logger.error('%s of %s graphs failed', failures, len(all_params))
+
+if __name__ == '__main__':
+    setup_logging()
+    render_all()
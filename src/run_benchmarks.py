@@ -0,0 +1,102 @@
+# encoding=utf8
+'''
+Запуск бенчмарков.
+Результаты печатаются, сохраняются в JSON и сравниваются с предыдущим запуском.
+@author: Mic, 2012
+'''
+
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+
+from benchmarks.storage import use_memory_database, use_real_database
+from benchmarks.suite import BenchmarkSuite
+from dmte.log import logger, setup_logging
+
+# Количества объявлений в БД по умолчанию. В mongomock поиск объявлений по
+# идентификаторам перебирает всю коллекцию, и сохранение растет квадратично
+# (5000 объявлений - несколько минут), поэтому без настоящего сервера размеры меньше:
+DEFAULT_SIZES = {
+    'mongomock': [500, 2000],
+    'mongodb': [1000, 10000],
+}
+
+# Каталог для результатов:
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'results')
+
+def get_previous_results():
+    '''
+    Возвращает результаты предыдущего запуска по ключам.
+    @return: dict
+    '''
+    if not os.path.isdir(RESULTS_DIR):
+        return {}
+    names = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith('.json'))
+    if not names:
+        return {}
+    with open(os.path.join(RESULTS_DIR, names[-1])) as results_file:
+        previous = json.load(results_file)
+    return dict(('%s@%s'%(result['name'], result['size']) if result['size'] is not None else result['name'], result)
+                for result in previous['results'])
+
+def save_results(results, storage, path):
+    '''
+    Сохраняет результаты в JSON.
+    @param results: list
+    @param storage: str
+    @param path: str
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as results_file:
+        json.dump({
+            'started': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'storage': storage,
+            'results': [result.to_dict() for result in results],
+        }, results_file, indent=2)
+    logger.info('results saved to %s', path)
+
+def compare_results(results, previous):
+    '''
+    Печатает изменение производительности относительно предыдущего запуска.
+    @param results: list
+    @param previous: dict
+    '''
+    for result in results:
+        if result.key not in previous or not previous[result.key]['rate']:
+            continue
+        change = result.rate / previous[result.key]['rate'] - 1
+        if change < -0.1:
+            logger.warning('%-24s %+.1f%%', result.key, change * 100)
+        else:
+            logger.info('%-24s %+.1f%%', result.key, change * 100)
+
+if __name__ == '__main__':
+    setup_logging()
+    argument_parser = ArgumentParser(description='Run offline benchmarks.')
+    argument_parser.add_argument('sizes', type=int, nargs='*',
+                                 help='advert counts to fill the database with (default: 500 2000 with mongomock, '
+                                 '1000 10000 with --real-db)')
+    argument_parser.add_argument('--real-db', action='store_true',
+                                 help='use a scratch database on the configured MongoDB server instead of mongomock')
+    argument_parser.add_argument('--output', help='where to save results as JSON')
+    arguments = argument_parser.parse_args()
+    storage = 'mongodb' if arguments.real_db else 'mongomock'
+    if arguments.real_db:
+        use_real_database()
+    else:
+        use_memory_database()
+    previous = get_previous_results()
+    suite = BenchmarkSuite(arguments.sizes or DEFAULT_SIZES[storage])
+    results = suite.run()
+    output = arguments.output or os.path.join(RESULTS_DIR, '%s.json'%datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+    save_results(results, storage, output)
+    compare_results(results, previous)
+    if suite.failures:
+        logger.error('%s checks failed', len(suite.failures))
+        sys.exit(1)
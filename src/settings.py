@@ -16,12 +16,101 @@ HTTP_SERVER = {
 
 # Настройки БД:
 MONGO_DB = {
+    # Хост (для набора реплик - список host:port через запятую):
     'host': 'localhost',
     'port': 27017,
     'db_name': '',
+    # Название набора реплик (None - одиночный сервер):
+    'replica_set': None,
+    # Максимальное количество подключений в пуле процесса:
+    'max_pool_size': 10,
+    # Таймауты (секунды): подключения, операции и ожидания свободного подключения в пуле:
+    'connect_timeout': 5,
+    'socket_timeout': 30,
+    'wait_queue_timeout': 5,
+    # Откуда читать данные для графиков (primary, primaryPreferred, secondary,
+    # secondaryPreferred, nearest); обход сайта всегда пишет и читает с primary:
+    'graph_read_preference': 'primary',
 }
 
+# Настройки получения исходных данных:
+SOURCE_DATA = {
+    'base_url': 'http://www.tomsk.ru09.ru',
+    'start_url': '/realty/?type=1&otype=1&listview=1&perpage=200',
+    # Сколько скачанных страниц может ждать разбора в режиме concurrent
+    # (разбор и сохранение идут в одном потоке, параллельно со скачиванием):
+    'prefetch_pages': 2,
+    # Минимальный интервал между запросами к сайту (секунды):
+    'host_interval': 1.0,
+    # Таймаут запроса (секунды):
+    'timeout': 30,
+    # Файл для ETag/Last-Modified скачанных страниц (None - не сохранять между запусками):
+    'validators_path': None,
+    # Каталог архива скачанных страниц (None - не сохранять страницы):
+    'archive_path': None,
+}
+
+# Откуда брать данные для графиков: adverts (объявления), pipeline (объявления, сгруппированные в БД)
+# или rollup (сводка по дням) - быстрее, но отклоняющиеся от средних значений цены отбрасываются
+# не по одному объявлению, а целыми дневными группами, поэтому графики могут отличаться:
+GRAPH_SOURCE = 'adverts'
+
+# Сохранение картинок графиков:
+GRAPH_IMAGE = {
+    # Степень сжатия PNG (0-9):
+    'compress_level': 6,
+    # Перевод в палитру: None - не переводить, web - готовая палитра (быстро,
+    # цвета округляются), adaptive - палитра по картинке (точные цвета, но медленно):
+    'palette': 'web',
+    # Количество цветов в палитре adaptive:
+    'palette_colors': 256,
+    # Размеры картинки (ширина, высота), которые можно запросить кроме размера по умолчанию.
+    # Каждый размер - отдельный график в кэше, поэтому список должен быть коротким:
+    'sizes': [(450, 165), (600, 220), (1800, 660)],
+    # Шрифт подписей:
+    'font_path': '/usr/share/fonts/truetype/ttf-dejavu/DejaVuSerif.ttf',
+    'font_size': 12,
+}
+
+# Метрики (/metrics):
+METRICS = {
+    # Файл, в который обход сайта пишет свои метрики и итоги (None - не писать):
+    'crawl_summary_path': None,
+}
+
+# Пул потоков для построения графиков (в каждом процессе uwsgi):
+RENDER_POOL = {
+    # Количество потоков:
+    'workers': 1,
+    # Сколько построений может ждать свободного потока (остальные запросы получают 503):
+    'queue_size': 4,
+    # Сколько запрос ждет построения (секунды):
+    'timeout': 30,
+    # Через сколько секунд повторить запрос после 503:
+    'retry_after': 5,
+}
+
+# Выборочное профилирование графиков и разбора страниц (переменная окружения
+# DMTE_PROFILE с долей профилируемых вызовов включает его в обход этих настроек):
+PROFILING = {
+    'enabled': False,
+    # Доля профилируемых вызовов:
+    'sample_rate': 0.01,
+    # Каталог для профилей:
+    'path': '/tmp/dmte-profiles',
+}
+
+# Словари настроек по умолчанию: локальные настройки обычно переопределяют словарь
+# целиком, и ключи, добавленные сюда позже, должны остаться со значениями по умолчанию:
+_DEFAULT_DICTS = dict((name, value) for name, value in globals().items() if name.isupper() and isinstance(value, dict))
+
 try:
     from settings_local import *
 except ImportError:
     pass
+
+for _name, _default in _DEFAULT_DICTS.items():
+    if globals()[_name] is not _default:
+        _merged = dict(_default)
+        _merged.update(globals()[_name])
+        globals()[_name] = _merged